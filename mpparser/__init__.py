@@ -16,4 +16,11 @@
 # See the License for the specific language governing per
 # limitations under the License.
 #
-from mpparser.mp_parser import MPParser
+
+
+def __getattr__(name):
+    # the parser is imported on first access, importing mpparser.matching stays cheap
+    if name == 'MPParser':
+        from mpparser.mp_parser import MPParser
+        return MPParser
+    raise AttributeError('module %r has no attribute %r' % (__name__, name))
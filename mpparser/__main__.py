@@ -17,16 +17,58 @@
 #
 
 import sys
-import json
 import logging
+import argparse
 
 from nomad.utils import configure_logging
 from nomad.datamodel import EntryArchive
-from mpparser import MPParser
+from mpparser.mp_parser import MPParser
+from mpparser.batch import find_mainfiles, run_batch
+from mpparser.output import write_json, write_msgpack
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m mpparser',
+        description=(
+            'Parses a MaterialsProject mainfile and writes the archive to stdout. With --output, '
+            'all mainfiles in the given files, directories and glob patterns are parsed '
+            'in parallel and one archive per material is written.'))
+    parser.add_argument('paths', nargs='*', help='mainfiles, directories or glob patterns')
+    parser.add_argument('--files-from', help='a file with one path per line')
+    parser.add_argument('-o', '--output', help='the directory to write the archives to')
+    parser.add_argument(
+        '-j', '--processes', type=int, default=None, help='number of processes, default all cores')
+    parser.add_argument(
+        '--max-in-flight', type=int, default=None,
+        help='maximum number of mainfiles queued in the pool, default twice the processes')
+    parser.add_argument(
+        '-f', '--format', choices=['json', 'msgpack'], default='json',
+        help='compact json or msgpack with binary arrays, see mpparser.output')
+    args = parser.parse_args(argv)
+
+    if args.output is None:
+        if len(args.paths) != 1 or args.files_from is not None:
+            parser.error('without --output exactly one mainfile is parsed')
+        configure_logging(console_log_level=logging.DEBUG)
+        archive = EntryArchive()
+        MPParser().parse(args.paths[0], archive, logging)
+        if args.format == 'json':
+            write_json(archive, sys.stdout)
+        else:
+            write_msgpack(archive, sys.stdout.buffer)
+        sys.stdout.flush()
+        return
+
+    configure_logging(console_log_level=logging.INFO)
+    mainfiles = find_mainfiles(args.paths, args.files_from)
+    summary = run_batch(
+        mainfiles, args.output, args.processes, args.max_in_flight, format=args.format)
+    print('parsed %d mainfiles with %d failures in %.1fs' % (
+        summary['n_mainfiles'], summary['n_failures'], summary['time']))
+    if summary['n_failures'] > 0:
+        sys.exit(1)
 
 
 if __name__ == "__main__":
-    configure_logging(console_log_level=logging.DEBUG)
-    archive = EntryArchive()
-    MPParser().parse(sys.argv[1], archive, logging)
-    json.dump(archive.m_to_dict(), sys.stdout, indent=2)
+    main()
@@ -0,0 +1,252 @@
+#
+# Copyright The NOMAD Authors.
+#
+# This file is part of NOMAD.
+# See https://nomad-lab.eu for further info.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+'''
+Fetches materials and their workflow documents from the MP API in batches of material
+ids and parses them in memory, without writing the documents to disk first.
+'''
+import os
+import time
+import codecs
+import logging
+import threading
+import queue
+import http.client
+from contextlib import contextmanager, ExitStack
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit, urlencode
+
+from nomad.datamodel import EntryArchive
+from mpparser.mp_parser import MPParser, get_material_keys
+from mpparser.loader import JSONStreamReader, prefetch
+from mpparser.stream import get_material_id
+
+
+default_url = 'https://api.materialsproject.org'
+# the endpoints of the materials documents and of the workflow documents, by handler name
+default_endpoints = dict(
+    materials='/materials/summary/', elastic='/materials/elasticity/',
+    eos='/materials/eos/', phonon='/materials/phonon/', thermo='/materials/thermo/',
+    tasks='/materials/tasks/')
+# responses that are retried, all other errors are raised immediately
+retry_statuses = {429, 500, 502, 503, 504}
+
+
+class RateLimiter:
+    '''
+    Spaces the requests of all threads so that at most rate requests start per second.
+    '''
+    def __init__(self, rate=None):
+        self.interval = 1 / rate if rate else 0
+        self._next = 0.
+        self._lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next)
+            self._next = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+
+class ConnectionPool:
+    '''
+    Keeps up to size persistent connections to the host of url. Connections are reused
+    by the threads in turn, a connection that failed is closed and not reused.
+    '''
+    def __init__(self, url, size=4, timeout=30.):
+        parts = urlsplit(url)
+        self.connection_class = (
+            http.client.HTTPSConnection if parts.scheme == 'https' else http.client.HTTPConnection)
+        self.host = parts.netloc
+        self.prefix = parts.path.rstrip('/')
+        self.timeout = timeout
+        self.n_connections = 0
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def connection(self):
+        with self._slots:
+            try:
+                connection = self._idle.get_nowait()
+            except queue.Empty:
+                connection = self.connection_class(self.host, timeout=self.timeout)
+                with self._lock:
+                    self.n_connections += 1
+            try:
+                yield connection
+            except BaseException:
+                connection.close()
+                raise
+            self._idle.put(connection)
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+class MPClient:
+    '''
+    Client for the MP API. Documents are requested in batches of batch_size material
+    ids over a pool of pool_size connections, with at most rate requests per second.
+    Failed requests and responses with a status in retry_statuses are retried up to
+    retries times with an exponential backoff, or after the Retry-After of the response.
+    The api key defaults to the MP_API_KEY environment variable.
+    '''
+    def __init__(
+            self, url=default_url, api_key=None, endpoints=None, batch_size=100, pool_size=4,
+            rate=10., retries=3, backoff=1., timeout=30.):
+        self.api_key = api_key if api_key is not None else os.environ.get('MP_API_KEY')
+        self.endpoints = dict(endpoints if endpoints is not None else default_endpoints)
+        if 'materials' not in self.endpoints:
+            raise ValueError('The endpoint of the materials documents is missing.')
+        self.batch_size = batch_size
+        self.pool_size = pool_size
+        self.retries = retries
+        self.backoff = backoff
+        self.pool = ConnectionPool(url, pool_size, timeout)
+        self.rate_limiter = RateLimiter(rate)
+
+    def close(self):
+        self.pool.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def request(self, path, params, selector=True):
+        '''
+        Requests path with the query params and returns the parts of the json response
+        selected by selector, see loader.compile_keys. The response is decoded while it
+        is received.
+        '''
+        url = '%s%s?%s' % (self.pool.prefix, path, urlencode(params))
+        headers = {'Accept': 'application/json'}
+        if self.api_key:
+            headers['X-API-KEY'] = self.api_key
+        for attempt in range(self.retries + 1):
+            delay = self.backoff * 2 ** attempt
+            self.rate_limiter.wait()
+            try:
+                with self.pool.connection() as connection:
+                    connection.request('GET', url, headers=headers)
+                    response = connection.getresponse()
+                    if response.status == 200:
+                        data = JSONStreamReader(codecs.getreader('utf-8')(response)).read(selector)
+                    # the response has to be read completely to reuse the connection
+                    response.read()
+            except (OSError, http.client.HTTPException) as e:
+                error = e
+            else:
+                if response.status == 200:
+                    return data
+                error = OSError('Request %s failed with status %d.' % (url, response.status))
+                if response.status not in retry_statuses:
+                    raise error
+                retry_after = response.getheader('Retry-After')
+                if retry_after is not None and retry_after.isdigit():
+                    delay = int(retry_after)
+            if attempt < self.retries:
+                time.sleep(delay)
+        raise error
+
+    def get_documents(self, name, material_ids, selector=True):
+        '''
+        Returns the documents of the endpoint name for the material ids. Endpoints can
+        return more documents than ids, e.g. tasks, the results are requested in pages.
+        '''
+        documents = []
+        while True:
+            params = {
+                'material_ids': ','.join(material_ids), '_all_fields': 'true',
+                '_skip': len(documents), '_limit': self.batch_size}
+            data = self.request(self.endpoints[name], params, dict(data={'*': selector}))
+            page = data.get('data') or []
+            documents.extend(page)
+            if len(page) < self.batch_size:
+                return documents
+
+    def get_batch(self, material_ids, selectors=None):
+        '''
+        Returns the materials documents and the workflow documents of all other
+        endpoints for the material ids. Selectors can map endpoint names to selectors.
+        '''
+        selectors = selectors if selectors is not None else dict()
+        documents = {
+            name: self.get_documents(name, material_ids, selectors.get(name, True))
+            for name in self.endpoints}
+        return documents.pop('materials'), [
+            document for name in self.endpoints if name in documents
+            for document in documents[name]]
+
+    def iter_documents(self, material_ids, selectors=None):
+        '''
+        Yields the material id, the materials document or None if it was not found and
+        the workflow documents of each material in the order of material_ids. Up to
+        pool_size batches are requested concurrently.
+        '''
+        material_ids = list(material_ids)
+        batches = [
+            material_ids[start:start + self.batch_size]
+            for start in range(0, len(material_ids), self.batch_size)]
+
+        def get_batch(batch):
+            return self.get_batch(batch, selectors)
+
+        with ThreadPoolExecutor(
+                max_workers=self.pool_size, thread_name_prefix='mpparser_api') as executor:
+            for batch, (materials, documents) in zip(
+                    batches, prefetch(executor, get_batch, batches, self.pool_size)):
+                materials = {material.get('material_id'): material for material in materials}
+                workflows = dict()
+                for document in documents:
+                    workflows.setdefault(get_material_id(document), []).append(document)
+                for material_id in batch:
+                    yield material_id, materials.get(material_id), workflows.get(material_id, [])
+
+
+def parse_api(material_ids, client=None, parser=None, logger=None):
+    '''
+    Fetches the materials with their workflow documents from the MP API and parses
+    them in memory. Yields one archive per material, materials that are not found are
+    logged and skipped.
+    '''
+    parser = parser if parser is not None else MPParser()
+    logger = logger if logger is not None else logging.getLogger(__name__)
+    with ExitStack() as stack:
+        if client is None:
+            client = stack.enter_context(MPClient())
+        selectors = {name: parser.handlers.get_keys() for name in client.endpoints}
+        selectors['materials'] = get_material_keys()
+        for material_id, material, documents in client.iter_documents(material_ids, selectors):
+            if material is None:
+                logger.warning('Material %s was not found.' % material_id)
+                continue
+            archive = EntryArchive()
+            parser.parse_documents(material, documents, archive, logger)
+            yield archive
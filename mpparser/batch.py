@@ -0,0 +1,128 @@
+#
+# Copyright The NOMAD Authors.
+#
+# This file is part of NOMAD.
+# See https://nomad-lab.eu for further info.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import os
+import re
+import glob
+import json
+import time
+import logging
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+from mpparser.matching import re_mainfile_name as re_mainfile
+
+
+_parser = None
+
+
+def find_mainfiles(paths, files_from=None):
+    '''
+    Returns the sorted mainfiles found in the given files, directories and glob patterns
+    and in the file list files_from with one path per line.
+    '''
+    paths = list(paths)
+    if files_from is not None:
+        with open(files_from) as f:
+            paths.extend([line.strip() for line in f if line.strip()])
+
+    mainfiles = set()
+    for path in paths:
+        matches = glob.glob(path, recursive=True) if glob.has_magic(path) else [path]
+        for match in matches:
+            if os.path.isdir(match):
+                for root, _, filenames in os.walk(match):
+                    mainfiles.update([
+                        os.path.join(root, filename) for filename in filenames
+                        if re_mainfile.fullmatch(filename)])
+            elif os.path.isfile(match) and re_mainfile.fullmatch(os.path.basename(match)):
+                mainfiles.add(match)
+
+    return sorted(os.path.abspath(mainfile) for mainfile in mainfiles)
+
+
+def get_output_path(mainfile, output_dir, root, extension='.archive.json'):
+    '''
+    Returns the archive path for mainfile, the directory structure below root is kept.
+    '''
+    path = os.path.relpath(mainfile, root)
+    return os.path.join(output_dir, re.sub(r'\.json(\.\w+)?$', '', path) + extension)
+
+
+def parse_mainfile(mainfile, output_path, format='json'):
+    # imported in the workers only, finding the mainfiles does not need nomad
+    from nomad.datamodel import EntryArchive
+    from mpparser.mp_parser import MPParser
+    from mpparser.output import write_archive
+
+    global _parser
+    if _parser is None:
+        _parser = MPParser()
+
+    start = time.perf_counter()
+    result = dict(mainfile=mainfile, archive=output_path)
+    try:
+        archive = EntryArchive()
+        _parser.parse(mainfile, archive, logging.getLogger('mpparser'))
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+        write_archive(archive, output_path, format)
+    except Exception as e:
+        result['error'] = '%s: %s' % (e.__class__.__name__, e)
+    result['time'] = time.perf_counter() - start
+    return result
+
+
+def run_batch(
+        mainfiles, output_dir, processes=None, max_in_flight=None, logger=None, format='json'):
+    '''
+    Parses the mainfiles in a process pool and writes one archive per mainfile to
+    output_dir in the given format, json or msgpack, see mpparser.output. At most
+    max_in_flight mainfiles are submitted to the pool at a time.
+    The per-file timings and failures are returned and written to summary.json.
+    '''
+    from mpparser.output import extensions
+
+    logger = logger if logger is not None else logging.getLogger(__name__)
+    processes = processes if processes else os.cpu_count()
+    max_in_flight = max_in_flight if max_in_flight else 2 * processes
+    root = os.path.commonpath([os.path.dirname(mainfile) for mainfile in mainfiles]) if mainfiles else ''
+
+    start = time.perf_counter()
+    results = []
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        in_flight = set()
+        for mainfile in mainfiles:
+            if len(in_flight) >= max_in_flight:
+                done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                results.extend([future.result() for future in done])
+            output_path = get_output_path(mainfile, output_dir, root, extensions[format])
+            in_flight.add(executor.submit(parse_mainfile, mainfile, output_path, format))
+        results.extend([future.result() for future in wait(in_flight).done])
+
+    results.sort(key=lambda result: result['mainfile'])
+    failures = [result for result in results if 'error' in result]
+    for failure in failures:
+        logger.error('failed to parse %s: %s' % (failure['mainfile'], failure['error']))
+
+    summary = dict(
+        n_mainfiles=len(results), n_failures=len(failures), processes=processes,
+        time=time.perf_counter() - start, results=results)
+    os.makedirs(output_dir, exist_ok=True)
+    with open(os.path.join(output_dir, 'summary.json'), 'w') as f:
+        json.dump(summary, f, indent=2)
+
+    return summary
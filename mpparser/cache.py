@@ -0,0 +1,246 @@
+#
+# Copyright The NOMAD Authors.
+#
+# This file is part of NOMAD.
+# See https://nomad-lab.eu for further info.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+'''
+Content-addressed on-disk cache of serialized archives, e.g.
+
+    MPParser(cache_dir='.mpparser_cache')
+    python -m mpparser.cache info --dir .mpparser_cache
+    python -m mpparser.cache prune --max-size 500M --dir .mpparser_cache
+'''
+import os
+import re
+import time
+import hashlib
+import argparse
+import tempfile
+import threading
+from functools import lru_cache
+
+try:
+    from importlib import metadata
+except ImportError:
+    # Python 3.7
+    metadata = None
+    import pkg_resources
+
+from mpparser.loader import default_backend
+
+
+# bump if the layout of the cache entries changes
+cache_format = '1'
+
+
+def hash_file(filepath, chunk_size=1 << 20):
+    stat = os.stat(filepath)
+    return _hash_file(filepath, stat.st_mtime_ns, stat.st_size, chunk_size)
+
+
+@lru_cache(maxsize=4096)
+def _hash_file(filepath, mtime_ns, size, chunk_size):
+    # the hash is reused as long as modification time and size do not change
+    digest = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def get_version(name):
+    '''
+    Returns the version of the installed distribution name or None.
+    '''
+    if metadata is None:
+        try:
+            return pkg_resources.get_distribution(name).version
+        except pkg_resources.DistributionNotFound:
+            return None
+    try:
+        return metadata.version(name)
+    except metadata.PackageNotFoundError:
+        return None
+
+
+@lru_cache(maxsize=1)
+def get_parser_version():
+    '''
+    Returns a version that changes with the parser and metainfo sources and the
+    installed nomad version.
+    '''
+    digest = hashlib.sha256(cache_format.encode())
+    root = os.path.dirname(os.path.abspath(__file__))
+    for directory, _, filenames in sorted(os.walk(root)):
+        for filename in sorted(filenames):
+            if filename.endswith('.py'):
+                with open(os.path.join(directory, filename), 'rb') as f:
+                    digest.update(f.read())
+    return '%s-%s' % (get_version('nomad-lab') or 'unknown', digest.hexdigest()[:16])
+
+
+def parse_size(size):
+    '''
+    Converts sizes like 1024, 500K, 20M or 1G to bytes.
+    '''
+    match = re.fullmatch(r'(\d+)([KMG]?)B?', str(size).strip().upper())
+    if match is None:
+        raise ValueError('Invalid size %s.' % size)
+    return int(match.group(1)) << {'': 0, 'K': 10, 'M': 20, 'G': 30}[match.group(2)]
+
+
+class ArchiveCache:
+    '''
+    Stores serialized archives under a key made from the content hashes of the input
+    files and the parser version. The least recently used entries are evicted once the
+    cache exceeds max_size bytes.
+    '''
+    def __init__(self, directory, max_size=1 << 30):
+        self.directory = directory
+        self.max_size = max_size
+        self._size = None
+        self._lock = threading.Lock()
+
+    def get_key(self, filepaths, options=None):
+        '''
+        Returns the key for the given input files. Options, e.g. parser settings that
+        change the archive, are part of the key.
+        '''
+        digest = hashlib.sha256(get_parser_version().encode())
+        digest.update(repr(options).encode())
+        for filepath in sorted(filepaths, key=os.path.basename):
+            digest.update(os.path.basename(filepath).encode())
+            digest.update(hash_file(filepath).encode())
+        return digest.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], '%s.json' % key)
+
+    def get(self, key):
+        '''
+        Returns the archive dict stored under key or None.
+        '''
+        path = self._path(key)
+        try:
+            with open(path) as f:
+                data = default_backend.loads(f.read())
+        except (OSError, ValueError):
+            return None
+        # the modification time marks the last use
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return data
+
+    def put(self, key, data):
+        '''
+        Stores the archive dict under key and evicts entries if the cache is full.
+        '''
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # written to a temporary file first, readers never see partial entries
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(default_backend.dumps(data))
+            size = os.path.getsize(tmp_path)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+        with self._lock:
+            if self._size is None:
+                self._size = sum(entry['size'] for entry in self.entries())
+            else:
+                self._size += size
+            if self._size > self.max_size:
+                self._size = self._prune(self.max_size)
+
+    def entries(self):
+        '''
+        Returns the cache entries sorted from the least to the most recently used.
+        '''
+        entries = []
+        if not os.path.isdir(self.directory):
+            return entries
+        for prefix in os.scandir(self.directory):
+            if not prefix.is_dir():
+                continue
+            for entry in os.scandir(prefix.path):
+                if not entry.name.endswith('.json'):
+                    continue
+                stat = entry.stat()
+                entries.append(dict(
+                    key=entry.name[:-len('.json')], path=entry.path, size=stat.st_size,
+                    last_used=stat.st_mtime))
+        return sorted(entries, key=lambda entry: entry['last_used'])
+
+    def _prune(self, max_size):
+        entries = self.entries()
+        size = sum(entry['size'] for entry in entries)
+        for entry in entries:
+            if size <= max_size:
+                break
+            try:
+                os.unlink(entry['path'])
+            except OSError:
+                continue
+            size -= entry['size']
+        return size
+
+    def prune(self, max_size=None):
+        '''
+        Evicts the least recently used entries until the cache is smaller than
+        max_size, by default the size of the cache. Returns the remaining size.
+        '''
+        with self._lock:
+            self._size = self._prune(self.max_size if max_size is None else max_size)
+            return self._size
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m mpparser.cache', description='Inspects and prunes the archive cache.')
+    parser.add_argument(
+        '--dir', default=os.environ.get('MPPARSER_CACHE_DIR', '.mpparser_cache'),
+        help='the cache directory, default MPPARSER_CACHE_DIR or .mpparser_cache')
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('info', help='prints the number of entries and the size')
+    commands.add_parser('list', help='lists the entries from the least recently used')
+    prune = commands.add_parser('prune', help='evicts the least recently used entries')
+    prune.add_argument(
+        '--max-size', help='the size to prune to, e.g. 500M, default the default cache size of 1G')
+    args = parser.parse_args(argv)
+
+    cache = ArchiveCache(args.dir)
+    if args.command == 'info':
+        entries = cache.entries()
+        print('%s: %d entries, %.1f MB' % (
+            args.dir, len(entries), sum(entry['size'] for entry in entries) / 2 ** 20))
+    elif args.command == 'list':
+        for entry in cache.entries():
+            print('%s %10d %s' % (
+                entry['key'], entry['size'],
+                time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(entry['last_used']))))
+    elif args.command == 'prune':
+        size = cache.prune(parse_size(args.max_size) if args.max_size is not None else None)
+        print('%s: %.1f MB left' % (args.dir, size / 2 ** 20))
+
+
+if __name__ == '__main__':
+    main()
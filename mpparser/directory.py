@@ -0,0 +1,112 @@
+#
+# Copyright The NOMAD Authors.
+#
+# This file is part of NOMAD.
+# See https://nomad-lab.eu for further info.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import os
+import re
+import threading
+from functools import lru_cache
+
+from mpparser.loader import JSONStreamReader, open_file, re_json_file
+
+
+# MP file names are prefixed with the material id, e.g. mp-149_phonon.json
+re_id_prefix = re.compile(r'^([a-z]+-\d+)(?![\d])')
+id_keys = dict(material_id=True, task_id=True)
+
+
+class DirectoryIndex:
+    '''
+    Groups the json files in a directory by the material id they belong to. The id is
+    taken from the file name prefix and, if there is none, read from the top-level
+    material_id or task_id of the file. The index is rebuilt only if the modification
+    time of the directory changes.
+    '''
+    def __init__(self, directory, sniff_size=4096):
+        self.directory = directory
+        self.sniff_size = sniff_size
+        self._mtime = None
+        self._files = dict()
+        self._sniffed = dict()
+        self._lock = threading.Lock()
+
+    def _sniff_id(self, filename):
+        path = os.path.join(self.directory, filename)
+        try:
+            stat = os.stat(path)
+            key = (filename, stat.st_mtime_ns, stat.st_size)
+            if key in self._sniffed:
+                return self._sniffed[key]
+            # only the top-level ids count, ids of nested documents, e.g. in the
+            # decomposes_to of thermo documents, are skipped. The file is read in chunks
+            # of sniff_size until the material id is found.
+            ids = dict()
+            with open_file(path) as f:
+                reader = JSONStreamReader(f, chunk_size=self.sniff_size)
+                for key, value in reader.iter_items(id_keys):
+                    ids[key] = value
+                    if key == 'material_id':
+                        break
+            material_id = ids.get('material_id', ids.get('task_id'))
+        except Exception:
+            return None
+        self._sniffed[key] = material_id
+        return material_id
+
+    def refresh(self):
+        try:
+            mtime = os.stat(self.directory).st_mtime_ns
+        except OSError:
+            mtime = None
+
+        with self._lock:
+            if mtime is not None and mtime == self._mtime:
+                return
+
+            files = dict()
+            filenames = os.listdir(self.directory) if mtime is not None else []
+            for filename in sorted(filenames):
+                if re_json_file.fullmatch(filename) is None:
+                    continue
+                match = re_id_prefix.match(filename)
+                material_id = match.group(1) if match else self._sniff_id(filename)
+                files.setdefault(material_id, []).append(filename)
+
+            self._files = files
+            self._mtime = mtime
+
+    def get(self, material_id, exclude=None):
+        '''
+        Returns the paths to the json files belonging to material_id.
+        '''
+        return [
+            os.path.join(self.directory, filename)
+            for filename in self._files.get(material_id, []) if filename != exclude]
+
+
+@lru_cache(maxsize=64)
+def _get_index(directory):
+    return DirectoryIndex(directory)
+
+
+def get_directory_index(directory):
+    '''
+    Returns the cached and up-to-date index of the given directory.
+    '''
+    index = _get_index(os.path.abspath(directory))
+    index.refresh()
+    return index
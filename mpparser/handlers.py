@@ -0,0 +1,163 @@
+#
+# Copyright The NOMAD Authors.
+#
+# This file is part of NOMAD.
+# See https://nomad-lab.eu for further info.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import io
+import os
+import re
+
+from mpparser.loader import JSONStreamReader, open_file, compile_keys, decode_array, compressions
+
+
+re_compression = re.compile(r'\.(?:%s)$' % '|'.join(compressions))
+
+
+class Handler:
+    '''
+    Parses the documents of one workflow type. Method is the name of the parser method
+    or a function that is called with the parser, the parse context and the document.
+    A document is handled if it has one of the top-level keys in detect and, if given,
+    condition returns true for it. Keys are the key paths read by the handler, see
+    compile_keys.
+
+    Files are only loaded if their name, without .json and compression extensions,
+    ends with one of suffixes or if one of the detect keys is found in the file head.
+    '''
+    def __init__(self, name, method, detect, keys=None, decoders=None, suffixes=(), condition=None):
+        self.name = name
+        self.method = method
+        self.detect = tuple(detect)
+        self.keys = list(keys) if keys is not None else list(self.detect)
+        self.decoders = decoders if decoders is not None else dict()
+        self.suffixes = tuple(suffixes)
+        self.condition = condition
+
+    def applies(self, data):
+        if not any(key in data for key in self.detect):
+            return False
+        return self.condition is None or bool(self.condition(data))
+
+    def parse(self, parser, context, data):
+        if isinstance(self.method, str):
+            getattr(parser, self.method)(context, data)
+        else:
+            self.method(parser, context, data)
+
+
+class HandlerRegistry:
+    '''
+    Ordered collection of handlers. Files are sniffed before they are loaded, only the
+    first sniff_size characters are read to decide if any handler can apply.
+    '''
+    def __init__(self, handlers=(), sniff_size=1 << 16):
+        self.handlers = list(handlers)
+        self.sniff_size = sniff_size
+        self._keys = None
+
+    def __iter__(self):
+        return iter(self.handlers)
+
+    def register(self, handler):
+        '''
+        Adds the handler after the already registered ones and returns it.
+        '''
+        if any(registered.name == handler.name for registered in self.handlers):
+            raise ValueError('A handler %s is already registered.' % handler.name)
+        self.handlers.append(handler)
+        self._keys = None
+        return handler
+
+    def get_keys(self):
+        '''
+        Returns the selector for the key paths read by all handlers.
+        '''
+        if self._keys is None:
+            keys, decoders = ['material_id', 'task_id'], dict()
+            for handler in self.handlers:
+                keys.extend(handler.keys)
+                decoders.update(handler.decoders)
+            self._keys = compile_keys(keys, decoders=decoders)
+        return self._keys
+
+    def sniff_keys(self, filepath):
+        '''
+        Returns the top-level keys that start within the first sniff_size characters.
+        '''
+        with open_file(filepath) as f:
+            head = f.read(self.sniff_size)
+        keys = []
+        try:
+            for key in JSONStreamReader(io.StringIO(head)).iter_keys():
+                keys.append(key)
+        except ValueError:
+            # the head ends within a value or the file is no json object
+            pass
+        return keys
+
+    def sniff(self, filepath):
+        '''
+        Returns the handlers that can apply to the file, based on the file name or,
+        if no suffix matches, on the keys in the file head.
+        '''
+        name = re_compression.sub('', os.path.basename(filepath))
+        name = name[:-len('.json')] if name.endswith('.json') else name
+        handlers = [
+            handler for handler in self.handlers
+            if handler.suffixes and name.endswith(handler.suffixes)]
+        if handlers:
+            return handlers
+        try:
+            keys = set(self.sniff_keys(filepath))
+        except Exception:
+            return []
+        return [
+            handler for handler in self.handlers if any(key in keys for key in handler.detect)]
+
+    def get_handlers(self, data):
+        '''
+        Returns the handlers that apply to the loaded document.
+        '''
+        return [handler for handler in self.handlers if handler.applies(data)]
+
+
+# the handlers of the MP workflow documents, everything else in the files is skipped
+registry = HandlerRegistry([
+    Handler('elastic', 'parse_elastic', ['elasticity'], suffixes=['_elasticity']),
+    Handler(
+        'eos', 'parse_eos', ['eos'], keys=['eos', 'volumes', 'energies'], suffixes=['_eos']),
+    Handler(
+        'phonon', 'parse_phonon', ['ph_bs', 'ph_dos'], keys=[
+            'ph_bs.labels_dict', 'ph_bs.has_nac',
+            'ph_dos.frequencies', 'ph_dos.densities', 'ph_dos.structure'], decoders={
+            'ph_bs.bands': decode_array,
+            'ph_bs.qpoints': decode_array,
+            'ph_dos.pdos': decode_array,
+            'ph_bs.eigendisplacements.real': decode_array,
+            'ph_bs.eigendisplacements.imag': decode_array}, suffixes=['_phonon']),
+    Handler(
+        'thermo', 'parse_thermo', ['property_name'], keys=[
+            'property_name', 'formation_energy_per_atom', 'nsites', 'energy_above_hull',
+            'is_stable', 'decomposes_to'], suffixes=['_thermo'],
+        condition=lambda data: data.get('property_name') == 'thermo'),
+    Handler(
+        'tasks', 'parse_tasks', ['calcs_reversed'], keys=[
+            'calcs_reversed.*.input.potcar_type', 'calcs_reversed.*.input.incar.ENCUT',
+            'calcs_reversed.*.input.incar.PREC'] + [
+            'calcs_reversed.*.output.ionic_steps.*.%s' % key
+            for key in ['e_fr_energy', 'e_wo_entrp', 'e_0_energy', 'structure']], decoders={
+            'calcs_reversed.*.output.ionic_steps.*.forces': decode_array,
+            'calcs_reversed.*.output.ionic_steps.*.stress': decode_array}, suffixes=['_tasks'])])
@@ -0,0 +1,72 @@
+#
+# Copyright The NOMAD Authors.
+#
+# This file is part of NOMAD.
+# See https://nomad-lab.eu for further info.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+'''
+Bookkeeping for incremental parsing, i.e. which sections of an archive were produced
+by which input file.
+'''
+
+
+def snapshot(archive):
+    '''
+    Returns the ids of all sections of the archive.
+    '''
+    return {id(section) for section in archive.m_all_contents(include_self=True)}
+
+
+def get_new_sections(archive, before):
+    '''
+    Returns the sections that were added since the snapshot before, without the
+    sections nested in other new sections.
+    '''
+    return [
+        section for section in archive.m_all_contents(
+            stop=lambda section: id(section) not in before)
+        if id(section) not in before and id(section.m_parent) in before]
+
+
+def remove_sections(sections):
+    '''
+    Removes the sections from their parents. The indices of the remaining repeated
+    sections are updated. References of the remaining sections to the removed ones,
+    e.g. to the system or method of another file, are unset.
+    '''
+    from nomad.metainfo import Reference
+
+    if not sections:
+        return
+
+    removed = {
+        id(nested) for section in sections
+        for nested in section.m_all_contents(include_self=True)}
+    # the references are resolved before the indices change
+    references = [
+        (section, quantity_def)
+        for section in sections[0].m_root().m_all_contents(include_self=True)
+        if id(section) not in removed
+        for quantity_def in section.m_def.all_quantities.values()
+        if isinstance(quantity_def.type, Reference) and not quantity_def.shape
+        if section.m_is_set(quantity_def) and id(section.m_get(quantity_def)) in removed]
+
+    # the last sections first, so that the indices of the others stay valid
+    for section in sorted(sections, key=lambda section: section.m_parent_index, reverse=True):
+        section.m_parent.m_remove_sub_section(
+            section.m_parent_sub_section, section.m_parent_index)
+
+    for section, quantity_def in references:
+        section.m_set(quantity_def, None)
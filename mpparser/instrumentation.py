@@ -0,0 +1,141 @@
+#
+# Copyright The NOMAD Authors.
+#
+# This file is part of NOMAD.
+# See https://nomad-lab.eu for further info.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import os
+import time
+import cProfile
+import logging
+import threading
+import tracemalloc
+from contextlib import contextmanager
+
+
+def log_event(logger, event, level=logging.INFO, **fields):
+    '''
+    Logs an event with structured fields. Stdlib loggers get the fields as extra
+    record attributes, nomad's structlog loggers as key-value pairs.
+    '''
+    if logger is logging or isinstance(logger, (logging.Logger, logging.LoggerAdapter)):
+        logger.log(level, event, extra=fields)
+    else:
+        getattr(logger, logging.getLevelName(level).lower())(event, **fields)
+
+
+class Instrumentation:
+    '''
+    Records the wall time, bytes read and allocation peak of parser stages and logs
+    each stage as a structured debug event and a summary of all stages as an info
+    event. Allocation peaks are only recorded while tracemalloc is tracing, e.g. with
+    trace_memory of MPParser. Before Python 3.9, tracemalloc cannot reset its peak, the
+    peaks are then measured since tracing started and are upper bounds of the stage peaks.
+    '''
+    def __init__(self, logger, enabled=True):
+        self.logger = logger
+        self.enabled = enabled
+        self.stages = []
+
+    @contextmanager
+    def stage(self, name, path=None, **fields):
+        '''
+        Measures the code in the context as a stage. If path is given, the size of the
+        file is recorded as bytes read. The yielded fields can be extended in the context.
+        '''
+        fields = dict(fields, stage=name)
+        if not self.enabled:
+            yield fields
+            return
+
+        tracing = tracemalloc.is_tracing()
+        if tracing:
+            if hasattr(tracemalloc, 'reset_peak'):
+                tracemalloc.reset_peak()
+            memory, _ = tracemalloc.get_traced_memory()
+        start = time.perf_counter()
+        try:
+            yield fields
+        finally:
+            fields['wall_time'] = time.perf_counter() - start
+            if path is not None:
+                fields['path'] = path
+                fields['bytes_read'] = os.path.getsize(path) if os.path.isfile(path) else 0
+            if tracing:
+                fields['memory_peak'] = tracemalloc.get_traced_memory()[1] - memory
+            self.stages.append(fields)
+            log_event(self.logger, 'parser stage', level=logging.DEBUG, **fields)
+
+    def log_summary(self, **fields):
+        '''
+        Logs the total bytes read and the maximum allocation peak of all recorded stages.
+        The wall time defaults to the sum of the stages.
+        '''
+        if not self.enabled:
+            return
+        fields.setdefault('wall_time', sum(stage['wall_time'] for stage in self.stages))
+        fields['bytes_read'] = sum(stage.get('bytes_read', 0) for stage in self.stages)
+        peaks = [stage['memory_peak'] for stage in self.stages if 'memory_peak' in stage]
+        if peaks:
+            fields['memory_peak'] = max(peaks)
+        log_event(self.logger, 'parser stages', n_stages=len(self.stages), **fields)
+
+
+_tracing_lock = threading.Lock()
+_tracing = [0]
+
+
+@contextmanager
+def trace_memory(enabled=True):
+    '''
+    Traces allocations with tracemalloc in the context, unless it is already tracing.
+    Contexts can be entered by concurrent threads, tracing stops when the last one exits.
+    '''
+    if not enabled:
+        yield
+        return
+    with _tracing_lock:
+        start = _tracing[0] > 0 or not tracemalloc.is_tracing()
+        if start:
+            _tracing[0] += 1
+            if _tracing[0] == 1:
+                tracemalloc.start()
+    try:
+        yield
+    finally:
+        if start:
+            with _tracing_lock:
+                _tracing[0] -= 1
+                if _tracing[0] == 0:
+                    tracemalloc.stop()
+
+
+@contextmanager
+def profile(path=None):
+    '''
+    Profiles the code in the context with cProfile and writes the stats to path, which
+    can be analysed with pstats or snakeviz. Does nothing if path is None.
+    '''
+    if path is None:
+        yield
+        return
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        profiler.dump_stats(path)
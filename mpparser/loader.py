@@ -0,0 +1,589 @@
+#
+# Copyright The NOMAD Authors.
+#
+# This file is part of NOMAD.
+# See https://nomad-lab.eu for further info.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import os
+import re
+import bz2
+import gzip
+import json
+import lzma
+from collections import deque
+from itertools import islice
+import numpy as np
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import simdjson
+except ImportError:
+    simdjson = None
+
+
+re_whitespace = re.compile(r'\s*')
+re_string_end = re.compile(r'(?:[^"\\]|\\.)*"', re.DOTALL)
+re_scalar_end = re.compile(r'[^,\]}\s]*')
+re_brackets = re.compile(r'[\[\]{}]')
+brackets = str.maketrans('[]', '  ')
+# the characters of numeric arrays, including NaN and Infinity
+number_chars = b'-+.,0123456789 \t\r\n[]eENaIfinty'
+
+compressions = {'gz': gzip.open, 'bz2': bz2.open, 'xz': lzma.open}
+re_json_file = re.compile(r'.+\.json(?:\.(?:%s))?' % '|'.join(compressions))
+
+
+def open_file(filepath):
+    '''
+    Opens a text file, files ending with .gz, .bz2 or .xz are decompressed while
+    they are read.
+    '''
+    extension = filepath.rsplit('.', 1)[-1]
+    if extension in compressions:
+        return compressions[extension](filepath, 'rt')
+    return open(filepath)
+
+
+def get_shape(text, chunk_size=1 << 20):
+    '''
+    Returns the shape of the json text of a regular nested list of numbers or None if
+    the innermost lists are empty. The text is scanned in chunks of chunk_size characters.
+    '''
+    end = text.index(']')
+    first = text[text.rindex('[', 0, end) + 1:end]
+    if not first.strip():
+        return None
+
+    # per nesting level, the number of lists and the number of commas in each of them,
+    # which has to be the same for all lists of a level. The lists of a level are
+    # closed before the next one is opened, so the commas of a list are counted from
+    # the running comma count at its opening to that at its closing bracket.
+    n_arrays, n_commas, opened, sizes = [], [], [], []
+    depth = 0
+    for start in range(0, len(text), chunk_size):
+        chars = np.frombuffer(text[start:start + chunk_size].encode(), dtype=np.uint8)
+        opening = chars == ord('[')
+        closing = chars == ord(']')
+        depths = np.cumsum(opening.view(np.int8) - closing.view(np.int8), dtype=np.int16)
+        depths += depth
+        depth = depths[-1] if len(depths) > 0 else depth
+        commas = chars == ord(',')
+        n_levels = max(len(n_arrays), int(depths.max(initial=0)))
+        while len(n_arrays) < n_levels:
+            n_arrays.append(0)
+            n_commas.append(0)
+            opened.append(None)
+            sizes.append(set())
+        for level in range(n_levels):
+            in_level = depths == level + 1
+            comma_positions = np.flatnonzero(commas & in_level)
+            openings = np.searchsorted(comma_positions, np.flatnonzero(opening & in_level))
+            closings = np.searchsorted(
+                comma_positions, np.flatnonzero(closing & (depths == level)))
+            openings = openings + n_commas[level]
+            closings = closings + n_commas[level]
+            n_commas[level] += len(comma_positions)
+            n_arrays[level] += len(openings)
+            if opened[level] is not None:
+                openings = np.concatenate([[opened[level]], openings])
+            opened[level] = None
+            if len(openings) > len(closings):
+                opened[level] = openings[-1]
+                openings = openings[:-1]
+            if len(openings) != len(closings):
+                raise ValueError('Only regular arrays can be decoded.')
+            sizes[level].update(np.unique(closings - openings).tolist())
+
+    if depth != 0 or any(len(size) != 1 for size in sizes):
+        raise ValueError('Only regular arrays can be decoded.')
+    shape = [size.pop() + 1 for size in sizes]
+    if n_arrays != np.cumprod([1] + shape[:-1]).tolist():
+        raise ValueError('Only regular arrays can be decoded.')
+    return tuple(shape)
+
+
+def decode_into(text, out, chunk_size=1 << 20):
+    '''
+    Decodes the json text of a regular nested list of numbers into out, which must have
+    the shape of the list, e.g. the real part of a preallocated complex array. The text
+    is decoded in chunks of about chunk_size characters, so no temporary array or text
+    of the full size is created.
+    '''
+    # a flat view, which fails for arrays that cannot be flattened without a copy
+    values = out.view()
+    values.shape = (-1, )
+    start, n_values = 0, 0
+    while start < len(text):
+        end = text.find(',', start + chunk_size)
+        end = len(text) if end < 0 else end
+        # numpy fills in values that are no numbers, e.g. strings or null
+        if text[start:end].encode('latin-1', 'replace').translate(None, number_chars):
+            break
+        chunk = np.fromstring(text[start:end].translate(brackets), dtype=values.dtype, sep=',')
+        if n_values + chunk.size > values.size:
+            break
+        values[n_values:n_values + chunk.size] = chunk
+        n_values += chunk.size
+        start = end + 1
+    if start < len(text) or n_values != values.size:
+        raise ValueError('Only regular arrays can be decoded.')
+    return out
+
+
+class JSONBackend:
+    '''
+    Decodes json text with the stdlib json module. Regular numeric arrays are decoded
+    directly into numpy arrays, without creating the intermediate python lists.
+    '''
+    name = 'json'
+
+    def loads(self, text):
+        return json.loads(text)
+
+    def dumps(self, data):
+        return json.dumps(data)
+
+    def decode_array(self, text, dtype=np.float64):
+        if not isinstance(text, str):
+            # the value was already decoded
+            return np.asarray(text, dtype=dtype) if isinstance(text, list) else text
+        text = text.strip()
+        if not text.startswith('['):
+            return self.loads(text)
+        shape = get_shape(text)
+        if shape is None:
+            return np.array(self.loads(text), dtype=dtype)
+        return decode_into(text, np.empty(shape, dtype=dtype))
+
+
+class OrjsonBackend(JSONBackend):
+    '''
+    Uses orjson, which decodes numbers faster than numpy parses them from text. Arrays
+    with more than array_size characters of text are decoded by numpy, to not create
+    the python lists of their values. Text that orjson rejects, e.g. with the NaN and
+    Infinity written by the json module, is decoded with the json module.
+    '''
+    name = 'orjson'
+    array_size = 1 << 20
+
+    def loads(self, text):
+        try:
+            return orjson.loads(text)
+        except ValueError:
+            return super().loads(text)
+
+    def dumps(self, data):
+        return orjson.dumps(data, option=orjson.OPT_SERIALIZE_NUMPY).decode()
+
+    def decode_array(self, text, dtype=np.float64):
+        if not isinstance(text, str) or len(text) > self.array_size:
+            return super().decode_array(text, dtype)
+        return np.asarray(self.loads(text), dtype=dtype)
+
+
+class SimdjsonBackend(JSONBackend):
+    '''
+    Uses simdjson, which also exports numeric arrays as buffers for numpy. Text that
+    simdjson rejects, e.g. with NaN and Infinity, is decoded with the json module.
+    '''
+    name = 'simdjson'
+
+    def loads(self, text):
+        try:
+            return simdjson.loads(text)
+        except ValueError:
+            return super().loads(text)
+
+    def decode_array(self, text, dtype=np.float64):
+        if not isinstance(text, str):
+            return super().decode_array(text, dtype)
+        # a new parser per document, parsers only hold one document at a time
+        try:
+            document = simdjson.Parser().parse(text.encode())
+        except ValueError:
+            return super().decode_array(text, dtype)
+        if not isinstance(document, simdjson.Array):
+            return self.loads(text)
+        shape = []
+        item = document
+        while isinstance(item, simdjson.Array):
+            shape.append(len(item))
+            if len(item) == 0:
+                break
+            item = item[0]
+        try:
+            values = np.frombuffer(document.as_buffer(of_type='d'), dtype=np.float64)
+        except (TypeError, ValueError):
+            return np.array(self.loads(text), dtype=dtype)
+        if values.size != np.prod(shape):
+            raise ValueError('Only regular arrays can be decoded.')
+        return values.reshape(shape).astype(dtype, copy=False)
+
+
+backends = {
+    'simdjson': SimdjsonBackend if simdjson is not None else None,
+    'orjson': OrjsonBackend if orjson is not None else None,
+    'json': JSONBackend}
+
+
+def get_backend(name=None):
+    '''
+    Returns the json backend with the given name. By default the MPPARSER_JSON_BACKEND
+    environment variable or the fastest installed backend is used.
+    '''
+    name = name if name is not None else os.environ.get('MPPARSER_JSON_BACKEND')
+    if name is None:
+        name = [name for name, backend in backends.items() if backend is not None][0]
+    if backends.get(name) is None:
+        raise ValueError('The json backend %s is not available.' % name)
+    return backends[name]()
+
+
+default_backend = get_backend()
+
+
+def decode_array(text, dtype=np.float64, backend=None):
+    '''
+    Decodes the json text of a regular nested list of numbers into a numpy array.
+    '''
+    return (backend if backend is not None else default_backend).decode_array(text, dtype)
+
+
+def compile_keys(keys, decoders=None):
+    '''
+    Converts a list of key paths, e.g. ['ph_bs.bands', 'calcs_reversed.0.input'], into
+    a nested selector. Path components can be object keys, list indices or '*' to select
+    all items. A selector value of True selects the whole value. Decoders can map key
+    paths to functions that decode the raw json text of the value with a given backend,
+    e.g. decode_array. Decoders are also applied to values that were already decoded.
+    '''
+    selector = dict()
+    leaves = {key: True for key in keys}
+    leaves.update(decoders if decoders is not None else dict())
+    for key, leaf in leaves.items():
+        node = selector
+        parts = [int(part) if part.isdigit() else part for part in key.split('.')]
+        for n, part in enumerate(parts):
+            if node.get(part) is True or callable(node.get(part)):
+                break
+            if n == len(parts) - 1:
+                node[part] = leaf
+            else:
+                node = node.setdefault(part, dict())
+    return selector
+
+
+class JSONStreamReader:
+    '''
+    Incremental json reader which decodes only the values selected by a key selector.
+    All other values are scanned over in chunks without creating python objects. If
+    errors is a list, values that a decoder of the selector fails to decode are left
+    out and their keys are appended to errors, otherwise the decoder errors are raised.
+    '''
+    scan_size = 1 << 20
+
+    def __init__(self, f, chunk_size=1 << 16, backend=None, errors=None):
+        self.f = f
+        self.backend = backend if backend is not None else default_backend
+        self.errors = errors
+        self.chunk_size = chunk_size
+        self.buffer = ''
+        self.pos = 0
+        self.keep = None
+
+    def _fill(self):
+        cut = self.pos if self.keep is None else self.keep
+        # the kept text is copied on every fill, reading at least as much as is kept
+        # keeps reading large raw values linear
+        chunk = self.f.read(max(self.chunk_size, len(self.buffer) - cut))
+        if not chunk:
+            return False
+        self.buffer = self.buffer[cut:] + chunk
+        self.pos -= cut
+        if self.keep is not None:
+            self.keep -= cut
+        return True
+
+    def _peek(self):
+        while True:
+            self.pos = re_whitespace.match(self.buffer, self.pos).end()
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self._fill():
+                raise ValueError('Unexpected end of json document.')
+
+    def _expect(self, chars):
+        char = self._peek()
+        if char not in chars:
+            raise ValueError('Expected one of %s at position %d.' % (chars, self.pos))
+        self.pos += 1
+        return char
+
+    def _skip_string(self):
+        # position is after the opening quote
+        while True:
+            match = re_string_end.match(self.buffer, self.pos)
+            if match is not None:
+                self.pos = match.end()
+                return
+            if not self._fill():
+                raise ValueError('Unterminated string in json document.')
+
+    def _skip_brackets(self, depth, end):
+        # advances to end or to the bracket that closes the current value
+        if end - self.pos < 256:
+            for match in re_brackets.finditer(self.buffer, self.pos, end):
+                depth += 1 if match.group() in '[{' else -1
+                if not depth:
+                    self.pos = match.end()
+                    return depth
+            self.pos = end
+            return depth
+
+        # long runs, e.g. numeric arrays, are scanned with numpy in slices of scan_size
+        # characters, which bounds the temporary arrays
+        while self.pos < end:
+            stop = min(self.pos + self.scan_size, end)
+            chars = np.frombuffer(
+                self.buffer[self.pos:stop].encode('latin-1', 'replace'), dtype=np.uint8)
+            change = ((chars == 91) | (chars == 123)).view(np.int8)
+            change -= ((chars == 93) | (chars == 125)).view(np.int8)
+            depths = np.cumsum(change, dtype=np.int32)
+            closing = np.flatnonzero(depths == -depth)
+            if len(closing):
+                self.pos += int(closing[0]) + 1
+                return 0
+            self.pos = stop
+            depth += int(depths[-1])
+        return depth
+
+    def _skip_value(self):
+        char = self._peek()
+        if char == '"':
+            self.pos += 1
+            self._skip_string()
+        elif char in '[{':
+            self.pos += 1
+            depth = 1
+            while depth:
+                # the text between strings is scanned for brackets, strings are skipped
+                quote = self.buffer.find('"', self.pos)
+                end = quote if quote >= 0 else len(self.buffer)
+                depth = self._skip_brackets(depth, end)
+                if not depth:
+                    break
+                if quote >= 0:
+                    self.pos = quote + 1
+                    self._skip_string()
+                elif not self._fill():
+                    raise ValueError('Unexpected end of json document.')
+        else:
+            while True:
+                end = re_scalar_end.match(self.buffer, self.pos).end()
+                if end < len(self.buffer) or not self._fill():
+                    self.pos = end
+                    return
+
+    def _read_raw(self):
+        self._peek()
+        self.keep = self.pos
+        try:
+            self._skip_value()
+            return self.buffer[self.keep:self.pos]
+        finally:
+            self.keep = None
+
+    def _read_value(self):
+        return self.backend.loads(self._read_raw())
+
+    def _read_object(self, selector):
+        result = dict()
+        if self._peek() == '}':
+            self.pos += 1
+            return result
+        while True:
+            self._expect('"')
+            self.pos -= 1
+            key = self._read_value()
+            self._expect(':')
+            self._read_selected(selector.get(key, selector.get('*')), result, key)
+            if self._expect(',}') == '}':
+                return result
+
+    def _read_array(self, selector):
+        result = []
+        if self._peek() == ']':
+            self.pos += 1
+            return result
+        index = 0
+        while True:
+            self._read_selected(selector.get(index, selector.get('*')), result, None)
+            index += 1
+            if self._expect(',]') == ']':
+                return result
+
+    def _read_selected(self, selector, result, key):
+        if selector is None:
+            self._skip_value()
+            return
+        char = self._peek()
+        if callable(selector):
+            value = _decode(selector, self._read_raw(), self.backend, self.errors, key)
+            if value is _failed:
+                return
+        elif selector is True or char not in '[{':
+            value = self._read_value()
+        elif char == '{':
+            self.pos += 1
+            value = self._read_object(selector)
+        else:
+            self.pos += 1
+            value = self._read_array(selector)
+        if key is None:
+            result.append(value)
+        else:
+            result[key] = value
+
+    def iter_keys(self):
+        '''
+        Yields the top-level keys of an object document, the values are skipped.
+        '''
+        self._expect('{')
+        if self._peek() == '}':
+            return
+        while True:
+            self._expect('"')
+            self.pos -= 1
+            yield self._read_value()
+            self._expect(':')
+            self._skip_value()
+            if self._expect(',}') == '}':
+                return
+
+    def iter_items(self, selector):
+        '''
+        Yields the top-level keys of an object document that are in selector together
+        with their selected values, all other values are skipped. The document is only
+        read as far as the items are taken.
+        '''
+        self._expect('{')
+        if self._peek() == '}':
+            return
+        while True:
+            self._expect('"')
+            self.pos -= 1
+            key = self._read_value()
+            self._expect(':')
+            item_selector = selector.get(key, selector.get('*'))
+            if item_selector is None:
+                self._skip_value()
+            else:
+                result = []
+                self._read_selected(item_selector, result, None)
+                if result:
+                    yield key, result[0]
+            if self._expect(',}') == '}':
+                return
+
+    def read(self, selector):
+        '''
+        Reads the document and returns only the parts selected by selector.
+        '''
+        result = []
+        self._read_selected(selector, result, None)
+        return result[0]
+
+
+# marks values that failed to decode
+_failed = object()
+
+
+def _decode(decoder, value, backend, errors, key):
+    if errors is None:
+        return decoder(value, backend=backend)
+    try:
+        return decoder(value, backend=backend)
+    except (ValueError, TypeError):
+        errors.append(key)
+        return _failed
+
+
+def select(data, selector, backend=None, errors=None):
+    '''
+    Returns the parts of decoded json data selected by selector, see compile_keys. If
+    errors is a list, values that fail to decode are left out, see JSONStreamReader.
+    '''
+    backend = backend if backend is not None else default_backend
+    if selector is True:
+        return data
+    if callable(selector):
+        return selector(data, backend=backend)
+
+    def select_item(key, value, item_selector):
+        if callable(item_selector):
+            return _decode(item_selector, value, backend, errors, key)
+        return select(value, item_selector, backend, errors)
+
+    if isinstance(data, dict):
+        items = [(key, selector.get(key, selector.get('*'))) for key in data]
+        items = [
+            (key, select_item(key, data[key], value)) for key, value in items if value is not None]
+        return {key: value for key, value in items if value is not _failed}
+    if isinstance(data, list):
+        items = [(index, selector.get(index, selector.get('*'))) for index in range(len(data))]
+        items = [
+            select_item(index, data[index], value) for index, value in items if value is not None]
+        return [value for value in items if value is not _failed]
+    return data
+
+
+def load_json(filepath, keys=None, backend=None, stream_size=1 << 18, errors=None):
+    '''
+    Loads a json document. If keys is given, only the values under these key paths
+    are decoded, see compile_keys. Only files larger than stream_size bytes are
+    streamed, smaller files are decoded at once by the backend, which is faster. If
+    errors is a list, values that fail to decode are left out, see JSONStreamReader.
+    '''
+    backend = backend if backend is not None else default_backend
+    selector = keys if keys is None or isinstance(keys, dict) else compile_keys(keys)
+    with open_file(filepath) as f:
+        if selector is None:
+            return backend.loads(f.read())
+        if os.path.getsize(filepath) <= stream_size:
+            return select(backend.loads(f.read()), selector, backend, errors)
+        return JSONStreamReader(f, backend=backend, errors=errors).read(selector)
+
+
+def prefetch(executor, func, items, ahead):
+    '''
+    Returns an iterator over func(item) for all items in order. The first ahead items
+    are submitted to the executor immediately and one more with each result taken, so
+    that at most ahead results are held in memory.
+    '''
+    items = iter(items)
+    futures = deque([executor.submit(func, item) for item in islice(items, ahead)])
+
+    def results():
+        while futures:
+            future = futures.popleft()
+            for item in islice(items, 1):
+                futures.append(executor.submit(func, item))
+            yield future.result()
+
+    return results()
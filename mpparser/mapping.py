@@ -0,0 +1,216 @@
+#
+# Copyright The NOMAD Authors.
+#
+# This file is part of NOMAD.
+# See https://nomad-lab.eu for further info.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+'''
+Declarative mappings of MP document keys onto metainfo quantities. The tables are
+compiled once per section definition into lists of extractor functions, which only look
+up the mapped keys, all other keys of the documents are never touched.
+'''
+from functools import lru_cache
+
+from mpparser.units import get_factor, scale
+
+
+class Mapping:
+    '''
+    Maps the value at the key path source, e.g. 'symmetry.number', onto the quantity
+    target. Numeric path components index lists and tuples. Values are converted with
+    convert and, if unit is given, from unit to the unit of the quantity. If the value is
+    missing, default is used if it is not None.
+    '''
+    def __init__(self, source, target, unit=None, convert=None, default=None):
+        self.source = source
+        self.path = tuple(int(part) if part.isdigit() else part for part in source.split('.'))
+        self.target = target
+        self.unit = unit
+        self.convert = convert
+        self.default = default
+
+
+class SubSectionMapping(Mapping):
+    '''
+    Maps the value at source onto the repeating sub-section target. A sub-section is
+    created for each item of a list value or each (key, value) pair of a dict value if
+    items is true, otherwise for the value itself. The mappings are applied to the items.
+    '''
+    def __init__(self, source, target, mappings, items=False):
+        super().__init__(source, target)
+        self.mappings = mappings
+        self.items = items
+
+
+def get_element(element):
+    # elements are serialized pymatgen Element objects
+    return element.get('element') if isinstance(element, dict) else element
+
+
+def label_mapping(source, target):
+    # dicts of labels and values, e.g. compositions, as sections with x_mp_label and x_mp_value
+    return SubSectionMapping(source, target, [
+        Mapping('0', 'x_mp_label'), Mapping('1', 'x_mp_value')], items=True)
+
+
+tables = dict(
+    run=[
+        Mapping('material_id', 'x_mp_material_id'),
+        Mapping('emmet_version', 'x_mp_emmet_version'),
+        Mapping('pymatgen_version', 'x_mp_pymatgen_version'),
+        Mapping('build_date', 'x_mp_build_date'),
+        Mapping('last_updated', 'x_mp_last_updated'),
+        Mapping('created_at', 'x_mp_created_at'),
+        Mapping('deprecated', 'x_mp_deprecated', convert=lambda value: str(value).lower()),
+        Mapping('cif', 'x_mp_cif'),
+        Mapping('icsd_id', 'x_mp_icsd_id'),
+        Mapping('tags', 'x_mp_n_tags', convert=len),
+        Mapping('tags', 'x_mp_tags'),
+        Mapping('task_ids', 'x_mp_n_tasks', convert=len),
+        Mapping('task_ids', 'x_mp_task_ids'),
+        label_mapping('calc_types', 'x_mp_calc_types'),
+        SubSectionMapping('origins', 'x_mp_origins', [
+            Mapping('name', 'x_mp_name'), Mapping('task_id', 'x_mp_task_id'),
+            Mapping('last_updated', 'x_mp_last_updated')])],
+    system=[
+        Mapping('formula_pretty', 'x_mp_formula_pretty'),
+        Mapping('formula_anonymous', 'x_mp_formula_anonymous'),
+        Mapping('chemsys', 'x_mp_chemsys'),
+        Mapping('oxide_type', 'x_mp_oxide_type'),
+        Mapping('volume', 'x_mp_volume'),
+        Mapping('density', 'x_mp_density'),
+        Mapping('density_atomic', 'x_mp_density_atomic'),
+        Mapping('nsites', 'x_mp_nsites'),
+        Mapping('nelements', 'x_mp_nelements'),
+        Mapping('elements', 'x_mp_elements', convert=lambda elements: [
+            get_element(element) for element in elements]),
+        label_mapping('composition', 'x_mp_composition'),
+        label_mapping('composition_reduced', 'x_mp_composition_reduced'),
+        SubSectionMapping('symmetry', 'x_mp_symmetry', [
+            Mapping(name, 'x_mp_%s' % name) for name in [
+                'symprec', 'version', 'source', 'symbol', 'number', 'point_group',
+                'crystal_system', 'hall']])],
+    elastic=[
+        Mapping('order', 'elastic_constants_order', default=2),
+        Mapping('deformations', 'n_deformations', convert=len),
+        Mapping('elastic_tensor', 'elastic_constants_matrix_second_order', 'GPa'),
+        Mapping('compliance_tensor', 'compliance_matrix_second_order', '1 / GPa'),
+        Mapping('g_reuss', 'shear_modulus_reuss', 'GPa'),
+        Mapping('g_voigt', 'shear_modulus_voigt', 'GPa'),
+        Mapping('g_vrh', 'shear_modulus_hill', 'GPa'),
+        Mapping('homogeneous_poisson', 'poisson_ratio_hill'),
+        Mapping('k_reuss', 'bulk_modulus_reuss', 'GPa'),
+        Mapping('k_voigt', 'bulk_modulus_voigt', 'GPa'),
+        Mapping('k_vrh', 'bulk_modulus_hill', 'GPa')],
+    eos=[
+        Mapping('volumes', 'volumes', 'angstrom ** 3'),
+        Mapping('energies', 'energies', 'eV'),
+        SubSectionMapping('eos', 'eos_fit', [
+            Mapping('0', 'function_name'),
+            Mapping('1.B', 'bulk_modulus', 'eV / angstrom ** 3'),
+            Mapping('1.C', 'bulk_modulus_derivative'),
+            Mapping('1.E0', 'equilibrium_energy', 'eV'),
+            Mapping('1.V0', 'equilibrium_volume', 'angstrom ** 3'),
+            Mapping('1.eos_energies', 'fitted_energies', 'eV')], items=True)])
+
+
+def get_sources(name):
+    '''
+    Returns the top-level keys read by the mappings of the table name.
+    '''
+    return list(dict.fromkeys(str(mapping.path[0]) for mapping in tables[name]))
+
+
+def _compile_getter(path):
+    if len(path) == 1 and isinstance(path[0], str):
+        key = path[0]
+        return lambda data: data.get(key) if isinstance(data, dict) else None
+
+    def get(data):
+        for part in path:
+            if isinstance(data, dict):
+                data = data.get(part)
+            elif isinstance(data, (list, tuple)) and isinstance(part, int) and part < len(data):
+                data = data[part]
+            else:
+                return None
+        return data
+
+    return get
+
+
+def _compile(section_def, mapping):
+    get = _compile_getter(mapping.path)
+
+    if isinstance(mapping, SubSectionMapping):
+        sub_section_def = section_def.all_sub_sections[mapping.target]
+        extractors = compile_mappings(sub_section_def.sub_section, mapping.mappings)
+        section_cls = sub_section_def.sub_section.section_cls
+        items = mapping.items
+
+        def extract_sub_sections(section, data):
+            value = get(data)
+            if value is None:
+                return
+            if items:
+                value = value.items()
+            elif not isinstance(value, list):
+                value = [value]
+            for item in value:
+                sub_section = section.m_create(section_cls, sub_section_def)
+                for extract in extractors:
+                    extract(sub_section, item)
+
+        return extract_sub_sections
+
+    quantity_def = section_def.all_quantities[mapping.target]
+    convert, default = mapping.convert, mapping.default
+    factor = get_factor(mapping.unit, quantity_def.unit) if mapping.unit is not None else None
+
+    def extract(section, data):
+        value = get(data)
+        if value is None:
+            if default is None:
+                return
+            value = default
+        if convert is not None:
+            value = convert(value)
+        if factor is not None:
+            value = scale(value, factor)
+        section.m_set(quantity_def, value)
+
+    return extract
+
+
+@lru_cache(maxsize=None)
+def _compile_table(section_def, name):
+    return compile_mappings(section_def, tables[name])
+
+
+def compile_mappings(section_def, mappings):
+    '''
+    Returns the extractors of the mappings onto sections of section_def. Each extractor
+    is called with the section and the document.
+    '''
+    return [_compile(section_def, mapping) for mapping in mappings]
+
+
+def apply_mappings(name, section, data):
+    '''
+    Sets the quantities and sub-sections of section from the document data with the
+    mappings of the table name, which are compiled on first use.
+    '''
+    for extract in _compile_table(section.m_def, name):
+        extract(section, data)
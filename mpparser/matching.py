@@ -0,0 +1,42 @@
+#
+# Copyright The NOMAD Authors.
+#
+# This file is part of NOMAD.
+# See https://nomad-lab.eu for further info.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+'''
+The attributes used to match MaterialsProject mainfiles. This module has no heavy
+dependencies, so that files can be matched without importing nomad or numpy.
+'''
+import re
+
+
+supported_compressions = ['gz', 'bz2', 'xz']
+mainfile_name_re = r'.*mp.+materials\.json(\.(%s))?' % '|'.join(supported_compressions)
+mainfile_mime_re = r'(application/json)|(text/.*)'
+mainfile_contents_re = r'"pymatgen_version":'
+
+re_mainfile_name = re.compile(mainfile_name_re)
+re_mainfile_contents = re.compile(mainfile_contents_re)
+
+
+def is_mainfile(filename, buffer=None):
+    '''
+    Returns whether filename, and if given the head of the file buffer, matches a
+    MaterialsProject mainfile.
+    '''
+    if re_mainfile_name.fullmatch(filename) is None:
+        return False
+    return buffer is None or re_mainfile_contents.search(buffer) is not None
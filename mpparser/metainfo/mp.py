@@ -303,6 +303,33 @@ class System(simulation.system.System):
     x_mp_composition_reduced = SubSection(sub_section=Composition.m_def, repeats=True)
 
 
+class Atoms(simulation.system.Atoms):
+
+    m_def = Section(validate=False, extends_base_section=True)
+
+    x_mp_fractional_positions = Quantity(
+        type=np.dtype(np.float64),
+        shape=['n_atoms', 3],
+        description='''
+        Positions of the sites in fractional coordinates of the lattice vectors.
+        ''')
+
+    x_mp_species = Quantity(
+        type=np.dtype(np.int32),
+        shape=['n_atoms', '*'],
+        description='''
+        Atomic numbers of the species on each site, padded with 0 for sites with fewer
+        species.
+        ''')
+
+    x_mp_occupancies = Quantity(
+        type=np.dtype(np.float64),
+        shape=['n_atoms', '*'],
+        description='''
+        Occupancies of the species on each site, see x_mp_species.
+        ''')
+
+
 class Hubbard(MSection):
 
     m_def = Section(validate=False)
@@ -348,3 +375,16 @@ class Calculation(simulation.calculation.Calculation):
         shape=[],
         description='''
         ''')
+
+
+class BandStructure(simulation.calculation.BandStructure):
+
+    m_def = Section(validate=False, extends_base_section=True)
+
+    x_mp_eigendisplacements = Quantity(
+        type=np.dtype(np.float64),
+        shape=['*', '*', '*', 3, 2],
+        description='''
+        Phonon eigendisplacements for each band, q-point, atom and direction. The last
+        dimension holds the real and imaginary part.
+        ''')
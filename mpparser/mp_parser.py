@@ -17,105 +17,159 @@
 # limitations under the License.
 #
 import os
+import time
 import logging
-import json
+from functools import lru_cache, partial
+from contextlib import ExitStack
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 
-from nomad.units import ureg
 from nomad.parsing.parser import FairdiParser
-from nomad.datamodel.metainfo.simulation.run import Run, Program
-from nomad.datamodel.metainfo.workflow import (
-    Workflow, Elastic, EquationOfState, EOSFit, Thermodynamics, Stability, Decomposition,
-    Phonon)
-from nomad.datamodel.metainfo.simulation.system import System, Atoms
-from nomad.datamodel.metainfo.simulation.method import (
-    Method, DFT, Electronic, XCFunctional, Functional, BasisSet, BasisSetCellDependent)
-from nomad.datamodel.metainfo.simulation.calculation import (
-    Calculation, Dos, DosValues, BandStructure, BandEnergies)
-from mpparser.metainfo.mp import Composition, Symmetry
+from mpparser.matching import (
+    mainfile_name_re, mainfile_mime_re, mainfile_contents_re, supported_compressions)
+from mpparser.directory import get_directory_index
+from mpparser.loader import load_json, compile_keys, prefetch
+from mpparser.handlers import registry
+from mpparser.phonon import (
+    get_segments, get_eigendisplacements, sum_by_label, EigendisplacementsDecoder)
+from mpparser.structure import convert_structure, get_structure_key
+from mpparser.tasks import get_ionic_steps
+from mpparser.units import set_si, to_si, get_factor
+from mpparser.mapping import apply_mappings, get_sources
+from mpparser.instrumentation import Instrumentation, log_event, profile, trace_memory
+from mpparser.cache import ArchiveCache, hash_file
+from mpparser.incremental import snapshot, get_new_sections, remove_sections
+
+# the metainfo sections and units are imported by the parse methods that use them, so
+# that matching and short-lived workers do not pay for importing them
+
+
+@lru_cache(maxsize=1)
+def get_material_keys():
+    '''
+    Returns the selector for the keys of the materials document that are mapped onto
+    the run and the system, all other keys are not loaded.
+    '''
+    return compile_keys(['material_id', 'structure'] + get_sources('run') + get_sources('system'))
+
+
+def get_system_key(sec_system, tolerance):
+    '''
+    Returns the structure key of a system added by parse_structure, see get_structure_key,
+    or None if the system has no atoms.
+    '''
+    sec_atoms = sec_system.atoms
+    if sec_atoms is None:
+        return None
+    lattice_vectors = sec_atoms.lattice_vectors
+    empty = np.zeros((0, 0))
+    return get_structure_key(dict(
+        lattice_vectors=lattice_vectors.to('angstrom').magnitude if lattice_vectors is not None else None,
+        fractional_positions=sec_atoms.x_mp_fractional_positions,
+        species=np.asarray(sec_atoms.x_mp_species if sec_atoms.x_mp_species is not None else empty),
+        occupancies=sec_atoms.x_mp_occupancies if sec_atoms.x_mp_occupancies is not None else empty),
+        tolerance)
+
+
+class ParseContext:
+    '''
+    The state of a single parse call: the mainfile, the target archive, the logger, the
+    loaded materials document and the stage instrumentation. A new context is created per
+    call and dropped when the call returns, the parser itself only holds its settings.
+    '''
+    def __init__(self, archive, logger=None, filepath=None, data=None, instrument=True):
+        self.archive = archive
+        self.logger = logger if logger is not None else logging.getLogger(__name__)
+        self.filepath = os.path.abspath(filepath) if filepath is not None else None
+        self.maindir = os.path.dirname(self.filepath) if filepath is not None else None
+        self.data = data if data is not None else dict()
+        # the systems of the run by structure key, see MPParser.parse_structure
+        self.systems = dict()
+        self.instrumentation = Instrumentation(self.logger, instrument)
 
 
 class MPParser(FairdiParser):
-    def __init__(self):
+    '''
+    Parses MP materials documents and their workflow files. All per-call state is kept
+    in a ParseContext, so that one parser can serve concurrent parse calls.
+    '''
+    def __init__(
+            self, qpoint_tolerance=1e-6, eigendisplacements_dtype=np.complex128,
+            mmap_threshold=1 << 26, instrument=True, trace_memory=False, profile_dir=None,
+            cache_dir=None, cache_size=1 << 30, handlers=None, prefetch=0, structure_tolerance=1e-5):
         super().__init__(
             name='parsers/mp', code_name='MaterialsProject',
             code_homepage='https://materialsproject.org',
-            mainfile_mime_re=r'(application/json)|(text/.*)',
-            mainfile_name_re=r'.*mp.+materials\.json',
-            mainfile_contents_re=(r'"pymatgen_version":'))
-
-    def init_parser(self):
+            mainfile_mime_re=mainfile_mime_re,
+            mainfile_name_re=mainfile_name_re,
+            mainfile_contents_re=mainfile_contents_re,
+            supported_compressions=supported_compressions)
+        # tolerance for matching q-points to the high-symmetry points
+        self.qpoint_tolerance = qpoint_tolerance
+        # eigendisplacements larger than mmap_threshold bytes are memory-mapped
+        self.eigendisplacements_dtype = eigendisplacements_dtype
+        self.mmap_threshold = mmap_threshold
+        # stages are logged as structured events, allocation peaks only with trace_memory
+        self.instrument = instrument
+        self.trace_memory = trace_memory
+        # if given, a cProfile dump is written per mainfile
+        self.profile_dir = profile_dir if profile_dir is not None else os.environ.get(
+            'MPPARSER_PROFILE_DIR')
+        # if given, archives are cached under the hashes of their input files
+        cache_dir = cache_dir if cache_dir is not None else os.environ.get('MPPARSER_CACHE_DIR')
+        self.cache = ArchiveCache(cache_dir, cache_size) if cache_dir is not None else None
+        # the workflow handlers, handlers registered with mpparser.handlers.registry
+        # apply to all parsers that use the default
+        self.handlers = handlers if handlers is not None else registry
+        # if larger than 0, up to prefetch workflow files are loaded ahead in threads
+        # while the system is parsed, the handlers are still applied in file order
+        self.prefetch = prefetch
+        # structures that agree within the tolerance, in angstrom and fractional
+        # coordinates, share one system
+        self.structure_tolerance = structure_tolerance
+
+    def get_cache_options(self):
+        # the parser settings that change the archive
+        return (
+            self.qpoint_tolerance, np.dtype(self.eigendisplacements_dtype).str,
+            [handler.name for handler in self.handlers], self.structure_tolerance)
+
+    def init_parser(self, context):
         try:
-            self.data = json.load(open(self.filepath))
+            context.data = load_json(context.filepath, get_material_keys())
         except Exception:
-            self.logger.error('Failed to load json file.')
+            context.logger.error('Failed to load json file.')
+            raise
+
+    def parse_elastic(self, context, source):
+        from nomad.datamodel.metainfo.workflow import Workflow, Elastic
 
-    def parse_elastic(self, source):
-        sec_workflow = self.archive.m_create(Workflow)
+        sec_workflow = context.archive.m_create(Workflow)
         sec_workflow.type = 'elastic'
         sec_elastic = sec_workflow.m_create(Elastic)
         sec_elastic.energy_stress_calculator = 'VASP'
         sec_elastic.calculation_method = 'stress'
-        source = source.get('elasticity', source)
-        sec_elastic.elastic_constants_order = source.get('order', 2)
-
-        deformations = source.get('deformations')
-        if deformations is not None:
-            sec_elastic.n_deformations = len(deformations)
-
-        elastic_tensor = source.get('elastic_tensor')
-        if elastic_tensor is not None:
-            sec_elastic.elastic_constants_matrix_second_order = elastic_tensor * ureg.GPa
-
-        compliance_tensor = source.get('compliance_tensor')
-        if compliance_tensor is not None:
-            sec_elastic.compliance_matrix_second_order = compliance_tensor * (1 / ureg.GPa)
-
-        if source.get('g_reuss') is not None:
-            sec_elastic.shear_modulus_reuss = source['g_reuss'] * ureg.GPa
-        if source.get('g_voigt') is not None:
-            sec_elastic.shear_modulus_voigt = source['g_voigt'] * ureg.GPa
-        if source.get('g_vrh') is not None:
-            sec_elastic.shear_modulus_hill = source['g_vrh'] * ureg.GPa
-        if source.get('homogeneous_poisson') is not None:
-            sec_elastic.poisson_ratio_hill = source['homogeneous_poisson']
-        if source.get('k_reuss') is not None:
-            sec_elastic.bulk_modulus_reuss = source['k_reuss'] * ureg.GPa
-        if source.get('k_voigt') is not None:
-            sec_elastic.bulk_modulus_voigt = source['k_voigt'] * ureg.GPa
-        if source.get('k_vrh') is not None:
-            sec_elastic.bulk_modulus_hill = source['k_vrh'] * ureg.GPa
-
-    def parse_eos(self, source):
-        sec_workflow = self.archive.m_create(Workflow)
+        apply_mappings('elastic', sec_elastic, source.get('elasticity', source))
+
+    def parse_eos(self, context, source):
+        from nomad.datamodel.metainfo.workflow import Workflow, EquationOfState
+
+        sec_workflow = context.archive.m_create(Workflow)
         sec_workflow.type = 'equation_of_state'
         sec_eos = sec_workflow.m_create(EquationOfState)
-        if source.get('volumes') is not None:
-            sec_eos.volumes = source['volumes'] * ureg.angstrom ** 3
-        if source.get('energies') is not None:
-            sec_eos.energies = source['energies'] * ureg.eV
-        for fit_function, result in source.get('eos', {}).items():
-            sec_eos_fit = sec_eos.m_create(EOSFit)
-            sec_eos_fit.function_name = fit_function
-            if result.get('B') is not None:
-                sec_eos_fit.bulk_modulus = result['B'] * ureg.eV / ureg.angstrom ** 3
-            if result.get('C') is not None:
-                sec_eos_fit.bulk_modulus_derivative = result['C']
-            if result.get('E0') is not None:
-                sec_eos_fit.equilibrium_energy = result['E0'] * ureg.eV
-            if result.get('V0') is not None:
-                sec_eos_fit.equilibrium_volume = result['V0'] * ureg.angstrom ** 3
-            if result.get('eos_energies') is not None:
-                sec_eos_fit.fitted_energies = result['eos_energies'] * ureg.eV
-
-    def parse_thermo(self, data):
-        sec_workflow = self.archive.m_create(Workflow)
+        apply_mappings('eos', sec_eos, source)
+
+    def parse_thermo(self, context, data):
+        from nomad.datamodel.metainfo.workflow import (
+            Workflow, Thermodynamics, Stability, Decomposition)
+
+        sec_workflow = context.archive.m_create(Workflow)
         sec_workflow.type = 'thermodynamics'
         sec_thermo = sec_workflow.m_create(Thermodynamics)
         sec_stability = sec_thermo.m_create(Stability)
-        sec_stability.formation_energy = data.get(
-            'formation_energy_per_atom', 0) * data.get('nsites', 1) * ureg.eV
-        sec_stability.delta_formation_energy = data.get('energy_above_hull', 0) * ureg.eV
+        set_si(sec_stability, 'formation_energy', data.get(
+            'formation_energy_per_atom', 0) * data.get('nsites', 1), 'eV')
+        set_si(sec_stability, 'delta_formation_energy', data.get('energy_above_hull', 0), 'eV')
         sec_stability.is_stable = data.get('is_stable')
         if data.get('decomposes_to') is not None:
             for system in data.get('decomposes_to'):
@@ -123,48 +177,89 @@ class MPParser(FairdiParser):
                 sec_decomposition.formula = system.get('formula')
                 sec_decomposition.fraction = system.get('amount')
 
-    def parse_phonon(self, data):
-        sec_workflow = self.archive.m_create(Workflow)
+    def parse_phonon(self, context, data):
+        from nomad.datamodel.metainfo.workflow import Workflow, Phonon
+        from nomad.datamodel.metainfo.simulation.calculation import (
+            Calculation, Dos, DosValues, BandStructure, BandEnergies)
+
+        sec_workflow = context.archive.m_create(Workflow)
         sec_workflow.type = 'phonon'
         sec_phonon = sec_workflow.m_create(Phonon)
         # TODO is vasp always mp calculator?
         sec_phonon.force_calculator = 'vasp'
 
-        calculations = self.archive.run[-1].calculation
-        calc = calculations[-1] if calculations else self.archive.run[-1].m_create(Calculation)
+        # the phonons have their own calculation with the phonon structure, which is
+        # usually that of the material and then shares its system
+        structure = (data.get('ph_dos') or {}).get('structure')
+        sec_system = (
+            self.parse_structure(context, structure) if structure is not None
+            else context.archive.run[-1].system[0])
+        calc = context.archive.run[-1].m_create(Calculation)
+        calc.system_ref = sec_system
 
         if data.get('ph_dos') is not None:
             sec_dos = calc.m_create(Dos, Calculation.dos_phonon)
-            sec_dos.energies = data['ph_dos']['frequencies'] * ureg.THz * ureg.h
-            dos = data['ph_dos']['densities'] * (1 / (ureg.THz * ureg.h))
-            sec_dos.total.append(DosValues(value=dos))
-
-        if data.get('ph_bs') is not None:
+            set_si(sec_dos, 'energies', data['ph_dos']['frequencies'], 'THz * h')
+            sec_dos_values = DosValues()
+            set_si(sec_dos_values, 'value', data['ph_dos']['densities'], '1 / (THz * h)')
+            sec_dos.total.append(sec_dos_values)
+
+            # the projected densities of all sites are converted as one array, the rows
+            # of each species are summed at once
+            pdos = data['ph_dos'].get('pdos')
+            if pdos is not None and len(pdos) > 0:
+                pdos = to_si(pdos, '1 / (THz * h)', DosValues.value.unit)
+                labels = sec_system.atoms.labels if structure is not None and sec_system.atoms is not None else None
+                labels = labels if labels is not None and len(labels) == len(pdos) else None
+                for n, value in enumerate(pdos):
+                    sec_dos_values = sec_dos.m_create(DosValues, Dos.atom_projected)
+                    sec_dos_values.atom_index = n
+                    if labels is not None:
+                        sec_dos_values.atom_label = labels[n]
+                    sec_dos_values.value = value
+                if labels is not None:
+                    for label, value in zip(*sum_by_label(pdos, labels)):
+                        sec_dos_values = sec_dos.m_create(DosValues, Dos.species_projected)
+                        sec_dos_values.atom_label = label
+                        sec_dos_values.value = value
+
+        ph_bs = data.get('ph_bs')
+        if ph_bs is not None and ph_bs.get('bands') is not None and ph_bs.get('qpoints') is not None:
             sec_phonon.with_non_analytic_correction = data['ph_bs'].get('has_nac')
             sec_bs = calc.m_create(BandStructure, Calculation.band_structure_phonon)
-            bands = np.transpose(data['ph_bs']['bands'])
-            qpoints = data['ph_bs']['qpoints']
+            # the energies of the whole path are converted once into one contiguous array
+            # of shape (1, qpoints, bands), the segments only hold views into it and the
+            # q-points
+            bands = np.asarray(data['ph_bs']['bands'], dtype=np.float64)
+            energies = np.empty((1, *bands.shape[::-1]))
+            np.multiply(bands.T, get_factor('THz * h', BandEnergies.energies.unit), out=energies[0])
+            qpoints = np.ascontiguousarray(data['ph_bs']['qpoints'], dtype=np.float64)
             labels = data['ph_bs']['labels_dict']
-            hisym_qpts = list(labels.values())
+            starts, ends, endpoints = get_segments(
+                qpoints, list(labels.values()), self.qpoint_tolerance)
             labels = list(labels.keys())
-            endpoints = []
-            for i, qpoint in enumerate(qpoints):
-                if qpoint in hisym_qpts:
-                    endpoints.append(i)
-                if len(endpoints) < 2:
-                    continue
+            for start, end, endpoint in zip(starts, ends, endpoints):
                 sec_segment = sec_bs.m_create(BandEnergies)
-                energies = bands[endpoints[0]: endpoints[1] + 1]
-                sec_segment.energies = np.reshape(energies, (1, *np.shape(energies))) * ureg.THz * ureg.h
-                sec_segment.kpoints = qpoints[endpoints[0]: endpoints[1] + 1]
-                sec_segment.endpoints_labels = [labels[hisym_qpts.index(qpoints[i])] for i in endpoints]
-                endpoints = []
-
-        calc.system_ref = self.archive.run[-1].system[0]
+                sec_segment.m_set(BandEnergies.energies, energies[:, start:end + 1])
+                sec_segment.m_set(BandEnergies.kpoints, qpoints[start:end + 1])
+                sec_segment.endpoints_labels = [labels[n] for n in endpoint]
+
+            eigendisplacements = data['ph_bs'].get('eigendisplacements')
+            if eigendisplacements is not None and all(
+                    eigendisplacements.get(part) is not None for part in ('real', 'imag')):
+                eigendisplacements = get_eigendisplacements(
+                    eigendisplacements['real'], eigendisplacements['imag'],
+                    self.eigendisplacements_dtype, self.mmap_threshold)
+                # stored as a view with the real and imaginary parts in the last dimension
+                sec_bs.x_mp_eigendisplacements = eigendisplacements.view(
+                    np.finfo(eigendisplacements.dtype).dtype).reshape(*eigendisplacements.shape, 2)
+
+    def parse_tasks(self, context, data):
+        from nomad.datamodel.metainfo.simulation.method import (
+            Method, DFT, Electronic, XCFunctional, Functional, BasisSet, BasisSetCellDependent)
+        from nomad.datamodel.metainfo.simulation.calculation import (
+            Calculation, Energy, EnergyEntry, Forces, ForcesEntry, Stress, StressEntry)
 
-        # TODO add eigendisplacements
-
-    def parse_tasks(self, data):
         if len(data['calcs_reversed']) == 0:
             return
 
@@ -172,7 +267,7 @@ class MPParser(FairdiParser):
             'PAW_PBE': ['GGA_X_PBE', 'GGA_C_PBE']
         }
 
-        sec_method = self.archive.run[-1].m_create(Method)
+        sec_method = context.archive.run[-1].m_create(Method)
         sec_xc_functional = XCFunctional()
         for potcar_type in data['calcs_reversed'][0].get('input', {}).get('potcar_type', []):
             for xc_functional in xc_func_mapping.get(potcar_type, []):
@@ -196,86 +291,327 @@ class MPParser(FairdiParser):
             sec_basis_set_cell_dependent = sec_basis.m_create(BasisSetCellDependent)
             sec_basis_set_cell_dependent.kind = 'plane waves'
             prec = 1.3 if 'acc' in prec else 1.0
-            sec_basis_set_cell_dependent.planewave_cutoff = encut * prec * ureg.eV
-
-        self.archive.run[-1].calculation[0].method_ref = sec_method
-
-    def parse(self, filepath, archive, logger):
-        self.filepath = os.path.abspath(filepath)
-        self.archive = archive
-        self.logger = logger if logger is not None else logging.getLogger(__name__)
-        self.maindir = os.path.dirname(self.filepath)
-
-        self.init_parser()
-
-        sec_run = archive.m_create(Run)
+            set_si(sec_basis_set_cell_dependent, 'planewave_cutoff', encut * prec, 'eV')
+
+        # the values of the ionic steps of each calculation are stacked and converted at once
+        sec_run = context.archive.run[-1]
+        energies = [('e_wo_entrp', Energy.total), ('e_fr_energy', Energy.free), ('e_0_energy', Energy.total_t0)]
+        for steps, values in get_ionic_steps(
+                data['calcs_reversed'], [key for key, _ in energies] + ['forces', 'stress']):
+            for key, unit, quantity_def in [
+                    *[(key, 'eV', EnergyEntry.value) for key, _ in energies],
+                    ('forces', 'eV / angstrom', ForcesEntry.value), ('stress', 'kbar', StressEntry.value)]:
+                if values[key] is not None:
+                    values[key] = to_si(values[key], unit, quantity_def.unit)
+
+            for n, step in enumerate(steps):
+                sec_calc = sec_run.m_create(Calculation)
+                sec_calc.method_ref = sec_method
+                sec_energy = None
+                for key, sub_section_def in energies:
+                    if values[key] is None or np.isnan(values[key][n]):
+                        continue
+                    sec_energy = sec_energy if sec_energy is not None else sec_calc.m_create(Energy)
+                    sec_energy.m_create(EnergyEntry, sub_section_def).value = values[key][n]
+                if values['forces'] is not None and not np.isnan(values['forces'][n]).all():
+                    sec_forces = sec_calc.m_create(Forces)
+                    sec_forces.m_create(ForcesEntry, Forces.total).value = values['forces'][n]
+                if values['stress'] is not None and not np.isnan(values['stress'][n]).all():
+                    sec_stress = sec_calc.m_create(Stress)
+                    sec_stress.m_create(StressEntry, Stress.total).value = values['stress'][n]
+                if step.get('structure') is not None:
+                    sec_calc.system_ref = self.parse_structure(context, step['structure'])
+
+    def parse_structure(self, context, structure):
+        '''
+        Returns the system with the atoms of the pymatgen structure dict. Structures that
+        are equal within structure_tolerance share one system of the run, only the first
+        is added and the others return a reference to it.
+        '''
+        from nomad.datamodel.metainfo.simulation.system import System, Atoms
+        # the extensions of the atoms section are defined with the mp metainfo
+        import mpparser.metainfo.mp  # noqa: F401
+
+        sec_run = context.archive.run[-1]
+        if structure is None:
+            return sec_run.m_create(System)
+
+        converted = convert_structure(structure)
+        key = get_structure_key(converted, self.structure_tolerance)
+        sec_system = context.systems.get(key)
+        if sec_system is not None:
+            return sec_system
+
+        sec_system = context.systems[key] = sec_run.m_create(System)
+        sec_atoms = sec_system.m_create(Atoms)
+        if converted['lattice_vectors'] is not None:
+            set_si(sec_atoms, 'lattice_vectors', converted['lattice_vectors'], 'angstrom')
+            sec_atoms.periodic = [True, True, True]
+        if converted['positions'] is not None:
+            set_si(sec_atoms, 'positions', converted['positions'], 'angstrom')
+        if converted['fractional_positions'] is not None:
+            sec_atoms.x_mp_fractional_positions = converted['fractional_positions']
+        if converted['labels']:
+            sec_atoms.labels = converted['labels']
+            sec_atoms.x_mp_species = converted['species']
+            sec_atoms.x_mp_occupancies = converted['occupancies']
+        return sec_system
+
+    def parse_system(self, context):
+        from nomad.datamodel.metainfo.simulation.run import Run, Program
+        # the extensions of the run and system sections are defined with the mp metainfo
+        import mpparser.metainfo.mp  # noqa: F401
+
+        sec_run = context.archive.m_create(Run)
         sec_run.program = Program(name='MaterialsProject', version="1.0.0")
+        apply_mappings('run', sec_run, context.data)
 
-        #  TODO system should be referenced
-        structure = self.data.get('structure')
-        if structure is not None:
-            labels = [site['label'] for site in structure.get('sites')]
-            positions = [site['xyz'] for site in structure.get('sites')]
-            cell = structure.get('lattice', {}).get('matrix')
-            sec_system = sec_run.m_create(System)
-            sec_atoms = sec_system.m_create(Atoms)
-            if cell is not None:
-                sec_atoms.lattice_vectors = cell * ureg.angstrom
-                sec_atoms.periodic = [True, True, True]
-            if positions:
-                sec_atoms.positions = positions * ureg.angstrom
-            if labels:
-                sec_atoms.labels = labels
-
-        for key, val in self.data.get('composition', {}).items():
-            sec_system.x_mp_composition.append(
-                Composition(x_mp_label=key, x_mp_value=val))
-
-        for key, val in self.data.get('composition_reduced', {}).items():
-            sec_system.x_mp_composition_reduced.append(
-                Composition(x_mp_label=key, x_mp_value=val))
-
-        symmetry = self.data.get('symmetry')
-        if symmetry is not None:
-            sec_symmetry = sec_system.m_create(Symmetry)
-            for key, val in symmetry.items():
-                try:
-                    setattr(sec_symmetry, 'x_mp_%s' % key, val)
-                except Exception:
-                    pass
-
-        # misc
-        sec_system.x_mp_elements = self.data.get('elements', [])
-        for key, val in self.data.items():
-            try:
-                setattr(sec_system, 'x_mp_%s' % key, val)
-            except Exception:
-                pass
+        sec_system = self.parse_structure(context, context.data.get('structure'))
+        apply_mappings('system', sec_system, context.data)
+
+    def parse_calculation(self, context):
+        '''
+        Adds the calculation of the material with its system and, if a tasks document
+        was parsed, its method. It is added after the calculations of the workflow
+        documents, as the normalizers take the last calculation as that of the entry.
+        '''
+        from nomad.datamodel.metainfo.simulation.calculation import Calculation
 
         # temporary fix to go through workflow normalization
+        sec_run = context.archive.run[-1]
         sec_calc = sec_run.m_create(Calculation)
-        sec_calc.system_ref = sec_system
-
-        # TODO should we use the MP api for workflow results?
-        workflow_files = [f for f in os.listdir(
-            self.maindir) if f.endswith('.json') and f != os.path.basename(self.filepath)]
-        for filename in workflow_files:
+        sec_calc.system_ref = sec_run.system[0]
+        if sec_run.method:
+            sec_calc.method_ref = sec_run.method[-1]
+
+    def parse_workflow(self, context, data):
+        for handler in self.handlers.get_handlers(data):
+            handler.parse(self, context, data)
+
+    def parse_documents(self, data, documents, archive, logger=None):
+        '''
+        Parses an already loaded materials document and its workflow documents, e.g.
+        from bulk exports, instead of a mainfile and its sibling files.
+        '''
+        context = ParseContext(archive, logger, data=data, instrument=self.instrument)
+        material_id = context.data.get('material_id')
+
+        with trace_memory(self.trace_memory):
+            with context.instrumentation.stage('parse_system', material_id=material_id):
+                self.parse_system(context)
+
+            for document in documents:
+                if document.get('material_id', document.get('task_id')) != material_id:
+                    continue
+                with context.instrumentation.stage('parse_workflow', material_id=material_id):
+                    self.parse_workflow(context, document)
+
+            self.parse_calculation(context)
+
+        context.instrumentation.log_summary(material_id=material_id)
+
+    def get_workflow_keys(self):
+        '''
+        Returns the selector of the workflow files. The eigendisplacements are decoded
+        directly into one complex array with eigendisplacements_dtype, which is
+        memory-mapped above mmap_threshold. The selector can only be used for one file.
+        '''
+        keys = self.handlers.get_keys()
+        parts = keys.get('ph_bs', dict()).get('eigendisplacements')
+        if not isinstance(parts, dict) or not all(callable(parts.get(part)) for part in ('real', 'imag')):
+            return keys
+        decoder = EigendisplacementsDecoder(self.eigendisplacements_dtype, self.mmap_threshold)
+        parts = dict(parts, real=decoder.real, imag=decoder.imag)
+        return dict(keys, ph_bs=dict(keys['ph_bs'], eigendisplacements=parts))
+
+    def load_workflow_file(self, context, workflow_file):
+        '''
+        Returns the data of the workflow file or None if no handler applies to it or it
+        cannot be read. Values that fail to decode are left out and logged.
+        '''
+        stage = context.instrumentation.stage
+        # files that no handler can parse are skipped after reading their head
+        with stage('sniff_workflow', file=workflow_file) as fields:
+            fields['handlers'] = [handler.name for handler in self.handlers.sniff(workflow_file)]
+        if not fields['handlers']:
+            return None
+
+        errors = []
+        with stage('load_workflow', path=workflow_file):
             try:
-                data = json.load(open(os.path.join(self.maindir, filename)))
+                data = load_json(workflow_file, self.get_workflow_keys(), errors=errors)
             except Exception:
+                log_event(
+                    context.logger, 'Failed to load workflow file.', level=logging.WARNING,
+                    file=workflow_file)
+                return None
+        if errors:
+            log_event(
+                context.logger, 'Failed to decode values of workflow file.',
+                level=logging.WARNING, file=workflow_file, keys=errors)
+        return data
+
+    def parse_workflow_data(self, context, workflow_file, data):
+        '''
+        Parses the data of a workflow file as returned by load_workflow_file.
+        '''
+        # make sure data matches that of system
+        if data is None or data.get('material_id', data.get('task_id')) != context.data.get('material_id'):
+            return
+
+        with context.instrumentation.stage('parse_workflow', file=workflow_file):
+            self.parse_workflow(context, data)
+
+    def parse_workflow_file(self, context, workflow_file):
+        self.parse_workflow_data(
+            context, workflow_file, self.load_workflow_file(context, workflow_file))
+
+    def parse_incremental(self, filepath, archive, sources=None, logger=None):
+        '''
+        Parses the mainfile like parse, but only the workflow files that were added,
+        changed or removed since the archive was created. Sources is the record of the
+        previous call: each input file name maps to its content hash and the paths of
+        the sections it produced. The sections of changed and removed files are removed,
+        the changed and added files are parsed again and their sections are appended,
+        all other sections are left untouched. If sources is not given or the mainfile
+        changed, the archive is parsed from scratch.
+
+        Returns the sources of the updated archive. Normalized data, e.g. results, is
+        not updated.
+        '''
+        context = ParseContext(archive, logger, filepath, instrument=self.instrument)
+        stage = context.instrumentation.stage
+
+        mainfile = os.path.basename(context.filepath)
+        hashes = {mainfile: hash_file(context.filepath)}
+        sources = dict(sources) if sources is not None else dict()
+
+        start = time.perf_counter()
+        with stage('init_parser', path=context.filepath):
+            self.init_parser(context)
+
+        with stage('directory_index', directory=context.maindir):
+            index = get_directory_index(context.maindir)
+            workflow_files = {
+                os.path.basename(workflow_file): workflow_file
+                for workflow_file in index.get(context.data.get('material_id'), exclude=mainfile)}
+        for name, workflow_file in workflow_files.items():
+            hashes[name] = hash_file(workflow_file)
+
+        sections = dict()
+        if sources.get(mainfile, {}).get('hash') == hashes[mainfile]:
+            sections = {
+                name: [context.archive.m_resolve(path) for path in source['sections']]
+                for name, source in sources.items()}
+        else:
+            # the system sections are parsed from the mainfile, everything is parsed again
+            remove_sections([
+                section for sub_section_def in context.archive.m_def.all_sub_sections.values()
+                if sub_section_def.name in ('run', 'workflow')
+                for section in context.archive.m_get_sub_sections(sub_section_def)])
+            before = snapshot(context.archive)
+            with stage('parse_system'):
+                self.parse_system(context)
+            sections[mainfile] = get_new_sections(context.archive, before)
+
+        for name in list(sections):
+            if name != mainfile and sources[name]['hash'] != hashes.get(name):
+                remove_sections(sections.pop(name))
+
+        # systems are only shared with the mainfile and within a workflow file, so that
+        # removing the sections of a file leaves no references to its systems
+        owned = {
+            id(section) for name, file_sections in sections.items() if name != mainfile
+            for section in file_sections}
+        systems = dict()
+        for sec_system in context.archive.run[-1].system if context.archive.run else []:
+            key = get_system_key(sec_system, self.structure_tolerance)
+            if key is not None and id(sec_system) not in owned:
+                systems.setdefault(key, sec_system)
+
+        # the calculation of the material is added again after those of the new files
+        if context.archive.run:
+            remove_sections([
+                sec_calc for sec_calc in context.archive.run[-1].calculation
+                if id(sec_calc) not in owned])
+
+        n_parsed = 0
+        for name, workflow_file in workflow_files.items():
+            if name in sections:
                 continue
-            # make sure data matches that of system
-            # TODO maybe better to simply compare filename prefix so no need to load data
-            if data.get('material_id', data.get('task_id')) != self.data.get('material_id'):
-                continue
+            context.systems = dict(systems)
+            before = snapshot(context.archive)
+            self.parse_workflow_file(context, workflow_file)
+            sections[name] = get_new_sections(context.archive, before)
+            n_parsed += 1
+        self.parse_calculation(context)
 
-            if 'elasticity' in data:
-                self.parse_elastic(data)
-            if 'eos' in data:
-                self.parse_eos(data)
-            if 'ph_bs' in data or 'ph_dos' in data:
-                self.parse_phonon(data)
-            if 'property_name' in data and data.get('property_name') == 'thermo':
-                self.parse_thermo(data)
-            if 'calcs_reversed' in data:
-                self.parse_tasks(data)
+        context.instrumentation.log_summary(
+            path=context.filepath, wall_time=time.perf_counter() - start, n_parsed=n_parsed)
+
+        # the paths of sections change if other sections were removed
+        return {
+            name: dict(hash=hashes[name], sections=[section.m_path() for section in sections[name]])
+            for name in sections}
+
+    def parse(self, filepath, archive, logger):
+        context = ParseContext(archive, logger, filepath, instrument=self.instrument)
+        stage = context.instrumentation.stage
+
+        profile_path = None
+        if self.profile_dir is not None:
+            name = os.path.basename(context.filepath).split('.json')[0]
+            profile_path = os.path.join(self.profile_dir, '%s.prof' % name)
+
+        start = time.perf_counter()
+        with trace_memory(self.trace_memory), profile(profile_path):
+            with stage('init_parser', path=context.filepath):
+                self.init_parser(context)
+
+            # documents from the MP api are parsed with mpparser.api.parse_api
+            with stage('directory_index', directory=context.maindir) as fields:
+                index = get_directory_index(context.maindir)
+                workflow_files = index.get(
+                    context.data.get('material_id'), exclude=os.path.basename(context.filepath))
+                fields['n_files'] = len(workflow_files)
+
+            if self.cache is not None:
+                with stage('archive_cache') as fields:
+                    cache_key = self.cache.get_key(
+                        [context.filepath] + workflow_files, options=self.get_cache_options())
+                    cached = self.cache.get(cache_key)
+                    fields['hit'] = cached is not None
+                if cached is not None:
+                    context.archive.m_update_from_dict(cached)
+                    context.instrumentation.log_summary(
+                        path=context.filepath, wall_time=time.perf_counter() - start)
+                    return
+
+            with ExitStack() as stack:
+                # the files are loaded lazily in order, or ahead while the system is parsed
+                loaded = map(partial(self.load_workflow_file, context), workflow_files)
+                if self.prefetch > 0 and workflow_files:
+                    executor = stack.enter_context(ThreadPoolExecutor(
+                        max_workers=min(self.prefetch, len(workflow_files)),
+                        thread_name_prefix='mpparser_prefetch'))
+                    loaded = prefetch(
+                        executor, partial(self.load_workflow_file, context), workflow_files,
+                        self.prefetch)
+
+                with stage('parse_system'):
+                    self.parse_system(context)
+
+                for workflow_file, data in zip(workflow_files, loaded):
+                    self.parse_workflow_data(context, workflow_file, data)
+
+            self.parse_calculation(context)
+
+            if self.cache is not None:
+                with stage('archive_cache_put'):
+                    try:
+                        self.cache.put(cache_key, context.archive.m_to_dict())
+                    except Exception:
+                        context.logger.warning('Failed to cache the archive.')
+
+        context.instrumentation.log_summary(
+            path=context.filepath, wall_time=time.perf_counter() - start)
@@ -0,0 +1,319 @@
+#
+# Copyright The NOMAD Authors.
+#
+# This file is part of NOMAD.
+# See https://nomad-lab.eu for further info.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+'''
+Writes archives section by section, without converting the whole archive into
+dicts first. Archives are written as compact json or in the msgpack format, in which
+numpy arrays are stored as raw little-endian buffers in an extension type. Both forms
+have the layout of EntryArchive.m_to_dict and the binary form can be read back with
+read_msgpack.
+'''
+import struct
+import numpy as np
+
+from mpparser.loader import default_backend
+
+
+# the msgpack extension type of numpy arrays
+array_ext_type = 1
+flush_size = 1 << 16
+
+
+def _get_sections(section):
+    '''
+    Returns the serialized quantities of the section as in m_to_dict, its numeric numpy
+    arrays and its sub-sections, without the contents of the sub-sections.
+    '''
+    from nomad.metainfo import SubSection
+
+    arrays = dict()
+
+    def exclude(definition, parent):
+        if isinstance(definition, SubSection):
+            return True
+        value = parent.__dict__.get(definition.name)
+        if isinstance(value, np.ndarray) and value.dtype.kind in 'biufc':
+            arrays[definition.name] = value
+            return True
+        return False
+
+    quantities = section.m_to_dict(exclude=exclude)
+    sub_sections = []
+    for sub_section_def in section.m_def.all_sub_sections.values():
+        sub_sections_ = section.m_get_sub_sections(sub_section_def)
+        if len(sub_sections_) == 0:
+            continue
+        sub_sections.append((
+            sub_section_def.name, sub_sections_ if sub_section_def.repeats else sub_sections_[0]))
+    return quantities, arrays, sub_sections
+
+
+def _write_json_array(f, array, backend):
+    # large arrays are written by rows to keep the text in memory small
+    if array.ndim < 2 or array.nbytes <= flush_size:
+        f.write(backend.dumps(array.tolist()))
+        return
+    f.write('[')
+    for n, row in enumerate(array):
+        if n > 0:
+            f.write(',')
+        _write_json_array(f, row, backend)
+    f.write(']')
+
+
+def write_json(archive, f, backend=None):
+    '''
+    Writes the archive as compact json to the text file f.
+    '''
+    backend = backend if backend is not None else default_backend
+
+    def write(section):
+        quantities, arrays, sub_sections = _get_sections(section)
+        items = [backend.dumps(key) + ':' + backend.dumps(value) for key, value in quantities.items()]
+        f.write('{' + ','.join(items))
+        n_items = len(items)
+        for key, value in arrays.items():
+            f.write('%s%s:' % (',' if n_items else '', backend.dumps(key)))
+            _write_json_array(f, value, backend)
+            n_items += 1
+        for name, value in sub_sections:
+            f.write('%s%s:' % (',' if n_items else '', backend.dumps(name)))
+            n_items += 1
+            if isinstance(value, list):
+                f.write('[')
+                for m, sub_section in enumerate(value):
+                    if m > 0:
+                        f.write(',')
+                    write(sub_section)
+                f.write(']')
+            else:
+                write(value)
+        f.write('}')
+
+    write(archive)
+
+
+class MsgpackWriter:
+    '''
+    Encodes values in the msgpack format into the binary file f. Numpy arrays are
+    written as extension type array_ext_type with the dtype, shape and raw data.
+    '''
+    def __init__(self, f):
+        self.f = f
+        self.buffer = bytearray()
+
+    def flush(self):
+        self.f.write(self.buffer)
+        self.buffer = bytearray()
+
+    def _header(self, size, fix, fix_size, codes):
+        if size < fix_size:
+            self.buffer.append(fix | size)
+        elif size < 1 << 16:
+            self.buffer += struct.pack('>BH', codes[0], size)
+        else:
+            self.buffer += struct.pack('>BI', codes[1], size)
+
+    def map_header(self, size):
+        self._header(size, 0x80, 16, (0xde, 0xdf))
+
+    def array_header(self, size):
+        self._header(size, 0x90, 16, (0xdc, 0xdd))
+
+    def pack(self, value):
+        buffer = self.buffer
+        if value is None:
+            buffer.append(0xc0)
+        elif value is True or value is False:
+            buffer.append(0xc3 if value else 0xc2)
+        elif isinstance(value, int):
+            if 0 <= value < 128:
+                buffer.append(value)
+            elif -32 <= value < 0:
+                buffer += struct.pack('>b', value)
+            elif value >= 0:
+                buffer += struct.pack('>BQ', 0xcf, value)
+            else:
+                buffer += struct.pack('>Bq', 0xd3, value)
+        elif isinstance(value, float):
+            buffer += struct.pack('>Bd', 0xcb, value)
+        elif isinstance(value, str):
+            encoded = value.encode()
+            if len(encoded) < 32:
+                buffer.append(0xa0 | len(encoded))
+            elif len(encoded) < 256:
+                buffer += struct.pack('>BB', 0xd9, len(encoded))
+            else:
+                self._header(len(encoded), 0, 0, (0xda, 0xdb))
+            buffer += encoded
+        elif isinstance(value, (bytes, bytearray)):
+            buffer += struct.pack('>BI', 0xc6, len(value))
+            buffer += value
+        elif isinstance(value, (list, tuple)):
+            self.array_header(len(value))
+            for item in value:
+                self.pack(item)
+        elif isinstance(value, dict):
+            self.map_header(len(value))
+            for key, item in value.items():
+                self.pack(key)
+                self.pack(item)
+        elif isinstance(value, np.ndarray):
+            self.pack_array(value)
+        elif isinstance(value, np.generic):
+            self.pack(value.item())
+        else:
+            raise TypeError('Cannot encode values of type %s.' % type(value).__name__)
+        if len(self.buffer) > flush_size:
+            self.flush()
+
+    def pack_array(self, array):
+        # native arrays on little-endian machines are not copied
+        array = np.ascontiguousarray(array).astype(array.dtype.newbyteorder('<'), copy=False)
+        dtype = array.dtype.str.encode()
+        header = struct.pack('<B', len(dtype)) + dtype + struct.pack(
+            '<B%dQ' % array.ndim, array.ndim, *array.shape)
+        self.buffer += struct.pack('>BIb', 0xc9, len(header) + array.nbytes, array_ext_type)
+        self.buffer += header
+        self.flush()
+        # the data is written from the array memory without copying it into the buffer
+        self.f.write(array.reshape(-1).view(np.uint8).data)
+
+
+def write_msgpack(archive, f):
+    '''
+    Writes the archive in the msgpack format to the binary file f.
+    '''
+    writer = MsgpackWriter(f)
+
+    def write(section):
+        quantities, arrays, sub_sections = _get_sections(section)
+        writer.map_header(len(quantities) + len(arrays) + len(sub_sections))
+        for key, value in quantities.items():
+            writer.pack(key)
+            writer.pack(value)
+        for key, value in arrays.items():
+            writer.pack(key)
+            writer.pack_array(value)
+        for name, value in sub_sections:
+            writer.pack(name)
+            if isinstance(value, list):
+                writer.array_header(len(value))
+                for sub_section in value:
+                    write(sub_section)
+            else:
+                write(value)
+
+    write(archive)
+    writer.flush()
+
+
+class MsgpackReader:
+    '''
+    Decodes msgpack data. Arrays of extension type array_ext_type are returned as
+    read-only numpy arrays on the data, other extension types as (type, bytes).
+    '''
+    def __init__(self, data):
+        self.data = memoryview(data)
+        self.pos = 0
+
+    def _read(self, size):
+        start = self.pos
+        self.pos += size
+        if self.pos > len(self.data):
+            raise ValueError('Unexpected end of msgpack data.')
+        return self.data[start:self.pos]
+
+    def _unpack(self, fmt):
+        return struct.unpack(fmt, self._read(struct.calcsize(fmt)))[0]
+
+    def _ext(self, size):
+        ext_type = self._unpack('>b')
+        data = self._read(size)
+        if ext_type != array_ext_type:
+            return ext_type, data.tobytes()
+        dtype_size = data[0]
+        dtype = np.dtype(data[1:1 + dtype_size].tobytes().decode())
+        ndim = data[1 + dtype_size]
+        offset = 2 + dtype_size + 8 * ndim
+        shape = struct.unpack('<%dQ' % ndim, data[2 + dtype_size:offset])
+        return np.frombuffer(data[offset:], dtype=dtype).reshape(shape)
+
+    def _read_map(self, size):
+        # the key has to be read before the value, which dict comprehensions only
+        # guarantee from Python 3.8 on
+        result = dict()
+        for _ in range(size):
+            key = self.read()
+            result[key] = self.read()
+        return result
+
+    def read(self):
+        code = self._read(1)[0]
+        if code < 0x80:
+            return code
+        if code >= 0xe0:
+            return code - 0x100
+        if code < 0x90:
+            return self._read_map(code & 0x0f)
+        if code < 0xa0:
+            return [self.read() for _ in range(code & 0x0f)]
+        if code < 0xc0:
+            return self._read(code & 0x1f).tobytes().decode()
+        if code == 0xc0:
+            return None
+        if code in (0xc2, 0xc3):
+            return code == 0xc3
+        if code in (0xc4, 0xc5, 0xc6):
+            return self._read(self._unpack({0xc4: '>B', 0xc5: '>H', 0xc6: '>I'}[code])).tobytes()
+        if code in (0xc7, 0xc8, 0xc9):
+            return self._ext(self._unpack({0xc7: '>B', 0xc8: '>H', 0xc9: '>I'}[code]))
+        if code in (0xca, 0xcb):
+            return self._unpack('>f' if code == 0xca else '>d')
+        if 0xcc <= code <= 0xd3:
+            return self._unpack('>' + 'BHIQbhiq'[code - 0xcc])
+        if 0xd4 <= code <= 0xd8:
+            return self._ext(1 << (code - 0xd4))
+        if code in (0xd9, 0xda, 0xdb):
+            return self._read(self._unpack({0xd9: '>B', 0xda: '>H', 0xdb: '>I'}[code])).tobytes().decode()
+        if code in (0xdc, 0xdd):
+            return [self.read() for _ in range(self._unpack('>H' if code == 0xdc else '>I'))]
+        if code in (0xde, 0xdf):
+            return self._read_map(self._unpack('>H' if code == 0xde else '>I'))
+        raise ValueError('Invalid msgpack type code 0x%x.' % code)
+
+
+def read_msgpack(f):
+    '''
+    Reads an archive written with write_msgpack from the binary file f.
+    '''
+    from nomad.datamodel import EntryArchive
+
+    return EntryArchive.m_from_dict(MsgpackReader(f.read()).read())
+
+
+formats = dict(json=write_json, msgpack=write_msgpack)
+extensions = dict(json='.archive.json', msgpack='.archive.msg')
+
+
+def write_archive(archive, path, format='json'):
+    '''
+    Writes the archive to path in the given format, json or msgpack.
+    '''
+    with open(path, 'w' if format == 'json' else 'wb') as f:
+        formats[format](archive, f)
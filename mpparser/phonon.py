@@ -0,0 +1,144 @@
+#
+# Copyright The NOMAD Authors.
+#
+# This file is part of NOMAD.
+# See https://nomad-lab.eu for further info.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import tempfile
+import numpy as np
+
+from mpparser.loader import decode_array, decode_into, get_shape
+
+
+def get_segments(qpoints, hisym_qpts, tolerance=1e-6):
+    '''
+    Splits a band structure path into segments between high-symmetry points. Points
+    match a high-symmetry point if all coordinates agree within tolerance. As in
+    pymatgen band structures, consecutive pairs of high-symmetry points delimit the
+    segments.
+
+    Returns the start and end indices of the segments (inclusive) and the indices of
+    the high-symmetry points at both ends.
+    '''
+    qpoints = np.asarray(qpoints, dtype=np.float64).reshape(-1, 3)
+    hisym_qpts = np.asarray(hisym_qpts, dtype=np.float64).reshape(-1, 3)
+    if len(qpoints) == 0 or len(hisym_qpts) == 0:
+        empty = np.zeros(0, dtype=int)
+        return empty, empty, np.zeros((0, 2), dtype=int)
+
+    # one vectorized pass over the path per high-symmetry point, the coordinates are
+    # compared column-wise on contiguous arrays to keep the temporaries small. Only the
+    # index of the first matching high-symmetry point is kept per q-point, so memory
+    # does not grow with the number of high-symmetry points.
+    coordinates = np.ascontiguousarray(qpoints.T)
+    first_match = np.full(len(qpoints), -1)
+    matches = np.empty(len(qpoints), dtype=bool)
+    for n, hisym_qpt in enumerate(hisym_qpts):
+        np.less_equal(np.abs(coordinates[0] - hisym_qpt[0]), tolerance, out=matches)
+        for i in (1, 2):
+            matches &= np.abs(coordinates[i] - hisym_qpt[i]) <= tolerance
+        matches &= first_match < 0
+        first_match[matches] = n
+
+    endpoints = np.flatnonzero(first_match >= 0)
+    endpoints = endpoints[:len(endpoints) // 2 * 2].reshape(-1, 2)
+    # the first matching high-symmetry point labels the endpoint
+    labels = first_match[endpoints]
+    return endpoints[:, 0], endpoints[:, 1], labels
+
+
+def _allocate(shape, dtype, mmap_threshold=None):
+    dtype = np.dtype(dtype)
+    if mmap_threshold is not None and int(np.prod(shape)) * dtype.itemsize > mmap_threshold:
+        # the scratch file is removed by the os once the array is released
+        with tempfile.TemporaryFile(prefix='mpparser_') as f:
+            return np.memmap(f, dtype=dtype, mode='w+', shape=tuple(shape))
+    return np.empty(shape, dtype=dtype)
+
+
+def get_eigendisplacements(real, imag, dtype=np.complex128, mmap_threshold=None):
+    '''
+    Combines the real and imaginary parts of the eigendisplacements into a single
+    complex array of shape (bands, qpoints, atoms, 3). Arrays larger than
+    mmap_threshold bytes are backed by a memory-mapped scratch file. Parts that were
+    already decoded into one complex array by an EigendisplacementsDecoder are
+    returned as they are.
+    '''
+    if real is imag and np.iscomplexobj(real):
+        return real
+    real = np.asarray(real)
+    eigendisplacements = _allocate(real.shape, dtype, mmap_threshold)
+    eigendisplacements.real = real
+    eigendisplacements.imag = imag
+    return eigendisplacements
+
+
+class EigendisplacementsDecoder:
+    '''
+    Decodes the json text of the real and imaginary parts of the eigendisplacements of
+    one document directly into the parts of a single complex array, see
+    get_eigendisplacements, without temporary arrays of the parts. The real and imag
+    methods are the decoders of the parts, see loader.compile_keys, both return the
+    complex array.
+    '''
+    def __init__(self, dtype=np.complex128, mmap_threshold=None):
+        self.dtype = dtype
+        self.mmap_threshold = mmap_threshold
+        self.eigendisplacements = None
+
+    def real(self, value, backend=None):
+        return self.decode(value, 'real', backend)
+
+    def imag(self, value, backend=None):
+        return self.decode(value, 'imag', backend)
+
+    def decode(self, value, part, backend=None):
+        shape = None
+        if isinstance(value, str):
+            value = value.strip()
+            shape = get_shape(value) if value.startswith('[') else None
+        if shape is None:
+            # lists that were already decoded or that have no values
+            value = np.asarray(decode_array(value, backend=backend))
+            shape = value.shape
+        if self.eigendisplacements is None:
+            self.eigendisplacements = _allocate(shape, self.dtype, self.mmap_threshold)
+        elif self.eigendisplacements.shape != tuple(shape):
+            raise ValueError('The real and imaginary parts have different shapes.')
+        out = getattr(self.eigendisplacements, part)
+        if isinstance(value, str):
+            decode_into(value, out)
+        else:
+            out[...] = value
+        return self.eigendisplacements
+
+
+def sum_by_label(values, labels):
+    '''
+    Sums the rows of values with equal labels, e.g. the projected DOS of the sites of
+    each species. Returns the distinct labels in the order of their first appearance
+    and an array with the sum of their rows.
+    '''
+    values = np.asarray(values)
+    unique, first, inverse = np.unique(
+        np.asarray(labels), return_index=True, return_inverse=True)
+    # groups are numbered by first appearance and the rows of each group made contiguous
+    order = np.argsort(first)
+    groups = np.empty_like(order)
+    groups[order] = np.arange(len(order))
+    groups = groups[inverse.reshape(-1)]
+    rows = np.argsort(groups, kind='stable')
+    starts = np.searchsorted(groups[rows], np.arange(len(order)))
+    return unique[order].tolist(), np.add.reduceat(values[rows], starts, axis=0)
@@ -0,0 +1,125 @@
+#
+# Copyright The NOMAD Authors.
+#
+# This file is part of NOMAD.
+# See https://nomad-lab.eu for further info.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import io
+from contextlib import ExitStack
+
+from nomad.datamodel import EntryArchive
+from mpparser.mp_parser import MPParser, get_material_keys
+from mpparser.loader import JSONStreamReader, open_file
+
+
+def material_id_key(material_id):
+    '''
+    Sort key for MP ids in natural order, e.g. mp-9 < mp-10.
+    '''
+    prefix, _, number = material_id.rpartition('-')
+    return (prefix, int(number)) if number.isdigit() else (material_id, -1)
+
+
+def get_material_id(document):
+    return document.get('material_id', document.get('task_id'))
+
+
+def iter_jsonl(f, selector=None):
+    '''
+    Yields the documents in a json lines file. If selector is given, only the
+    selected keys are decoded, see loader.compile_keys.
+    '''
+    for line in f:
+        line = line.strip()
+        if not line:
+            continue
+        yield JSONStreamReader(io.StringIO(line)).read(selector if selector else True)
+
+
+class SortedStream:
+    '''
+    Wraps an iterable of documents sorted by material id. Only the next document is
+    held in memory.
+    '''
+    def __init__(self, documents, key=material_id_key):
+        self._documents = iter(documents)
+        self._key = key
+        self._next = None
+        self._next_key = None
+        self._advance()
+
+    def _advance(self):
+        previous = self._next_key
+        self._next = self._next_key = None
+        for document in self._documents:
+            material_id = get_material_id(document)
+            if material_id is None:
+                continue
+            self._next, self._next_key = document, self._key(material_id)
+            if previous is not None and self._next_key < previous:
+                raise ValueError(
+                    'Documents are not sorted by material id, %s follows a larger id.' %
+                    material_id)
+            return
+
+    def pop(self, key):
+        '''
+        Returns the documents with the given key, documents with smaller keys are skipped.
+        '''
+        documents = []
+        while self._next_key is not None and self._next_key <= key:
+            if self._next_key == key:
+                documents.append(self._next)
+            self._advance()
+        return documents
+
+
+def join_by_material_id(materials, properties, key=material_id_key):
+    '''
+    Merge-joins the materials documents with the documents of the property streams.
+    All streams have to be sorted by material id with the same key, so that only one
+    document per stream is buffered. Yields the materials with their property documents.
+    '''
+    streams = [SortedStream(documents, key) for documents in properties]
+    previous = None
+    for material in materials:
+        material_id = material.get('material_id')
+        if material_id is None:
+            yield material, []
+            continue
+        material_key = key(material_id)
+        if previous is not None and material_key < previous:
+            raise ValueError(
+                'Materials are not sorted by material id, %s follows a larger id.' % material_id)
+        previous = material_key
+        yield material, [document for stream in streams for document in stream.pop(material_key)]
+
+
+def parse_jsonl(materials_path, property_paths, parser=None, logger=None, key=material_id_key):
+    '''
+    Parses a materials json lines export together with property exports, e.g. from
+    the elasticity, eos, phonon, thermo and tasks collections. All exports have to
+    be sorted by material id and can be compressed. Yields one archive per material.
+    '''
+    parser = parser if parser is not None else MPParser()
+    with ExitStack() as stack:
+        materials = iter_jsonl(stack.enter_context(open_file(materials_path)), get_material_keys())
+        properties = [
+            iter_jsonl(stack.enter_context(open_file(path)), parser.handlers.get_keys())
+            for path in property_paths]
+        for material, documents in join_by_material_id(materials, properties, key):
+            archive = EntryArchive()
+            parser.parse_documents(material, documents, archive, logger)
+            yield archive
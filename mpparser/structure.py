@@ -0,0 +1,106 @@
+#
+# Copyright The NOMAD Authors.
+#
+# This file is part of NOMAD.
+# See https://nomad-lab.eu for further info.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+from itertools import chain
+import numpy as np
+
+
+def convert_structure(structure):
+    '''
+    Converts a pymatgen structure dict, e.g. of materials, phonon, surface or tasks
+    documents, in a single pass over the sites. Cartesian and fractional positions are
+    derived from each other if only one is given.
+
+    Returns a dict with the lattice_vectors (3, 3) and the positions and
+    fractional_positions (n_sites, 3) in angstrom or None, the site labels and the
+    atomic numbers and occupancies of the species on each site (n_sites, max species
+    per site). Missing species are padded with atomic number 0 and occupancy 0,
+    unknown elements have atomic number -1.
+    '''
+    from ase.data import atomic_numbers
+
+    sites = structure.get('sites') or []
+    n_sites = len(sites)
+    xyz, abc, labels, numbers, occupancies, n_species = [], [], [], [], [], []
+    for site in sites:
+        xyz.append(site.get('xyz', ()))
+        abc.append(site.get('abc', ()))
+        species = site.get('species', ())
+        n_species.append(len(species))
+        for specie in species:
+            numbers.append(atomic_numbers.get(specie.get('element'), -1))
+            occupancies.append(specie.get('occu', 1.))
+        labels.append(site.get('label', species[0].get('element') if species else None))
+
+    matrix = (structure.get('lattice') or {}).get('matrix')
+    lattice_vectors = np.array(matrix, dtype=np.float64) if matrix is not None else None
+    positions = _to_array(xyz, n_sites)
+    fractional_positions = _to_array(abc, n_sites)
+    if lattice_vectors is not None:
+        if positions is None and fractional_positions is not None:
+            positions = fractional_positions @ lattice_vectors
+        elif fractional_positions is None and positions is not None:
+            fractional_positions = np.linalg.solve(lattice_vectors.T, positions.T).T
+
+    # the species of all sites are scattered into arrays padded to the largest site
+    n_species = np.array(n_species, dtype=int)
+    width = int(n_species.max()) if n_sites else 0
+    rows = np.repeat(np.arange(n_sites), n_species)
+    columns = np.arange(len(numbers)) - np.repeat(np.cumsum(n_species) - n_species, n_species)
+    species = np.zeros((n_sites, width), dtype=np.int32)
+    species[rows, columns] = numbers
+    occupancy = np.zeros((n_sites, width), dtype=np.float64)
+    occupancy[rows, columns] = occupancies
+
+    return dict(
+        lattice_vectors=lattice_vectors, positions=positions,
+        fractional_positions=fractional_positions, labels=labels, species=species,
+        occupancies=occupancy)
+
+
+def _to_array(vectors, n_sites):
+    # vectors are only converted if all sites have them
+    values = np.fromiter(chain.from_iterable(vectors), dtype=np.float64)
+    if n_sites == 0 or values.size != 3 * n_sites:
+        return None
+    return values.reshape(n_sites, 3)
+
+
+def get_structure_key(structure, tolerance=1e-5):
+    '''
+    Returns a hashable key of a structure as returned by convert_structure. The lattice
+    vectors in angstrom and the fractional positions, wrapped into the unit cell, are
+    rounded to multiples of tolerance, so structures with the same species and sites in
+    the same order that agree within about tolerance have the same key. Values close to
+    a rounding boundary can still give different keys.
+    '''
+    def round_values(values):
+        return np.round(np.asarray(values, dtype=np.float64) / tolerance).astype(np.int64)
+
+    species = structure['species']
+    key = [species.shape, species.astype(np.int32, copy=False).tobytes()]
+    key.append(round_values(structure['occupancies']).tobytes())
+    lattice_vectors = structure['lattice_vectors']
+    key.append(round_values(lattice_vectors).tobytes() if lattice_vectors is not None else None)
+    fractional_positions = structure['fractional_positions']
+    if fractional_positions is not None:
+        fractional_positions = round_values(fractional_positions) % int(round(1 / tolerance))
+        key.append(fractional_positions.tobytes())
+    else:
+        key.append(None)
+    return tuple(key)
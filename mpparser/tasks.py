@@ -0,0 +1,50 @@
+#
+# Copyright The NOMAD Authors.
+#
+# This file is part of NOMAD.
+# See https://nomad-lab.eu for further info.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import numpy as np
+
+
+def stack_steps(steps, key):
+    '''
+    Stacks the values of key in the ionic steps into one float64 array with the steps in
+    the first dimension. The array is allocated once from the first value and filled in a
+    single pass. Steps without the value are NaN. Returns None if no step has the value
+    or if the values differ in shape.
+    '''
+    first = next((step[key] for step in steps if step.get(key) is not None), None)
+    if first is None:
+        return None
+    values = np.full((len(steps), *np.shape(first)), np.nan)
+    try:
+        for n, step in enumerate(steps):
+            value = step.get(key)
+            if value is not None:
+                values[n] = value
+    except ValueError:
+        return None
+    return values
+
+
+def get_ionic_steps(calcs_reversed, keys):
+    '''
+    Yields the ionic steps of each calculation of a tasks document in chronological
+    order together with the stacked values of keys, see stack_steps.
+    '''
+    for calc in reversed(calcs_reversed):
+        steps = (calc.get('output') or {}).get('ionic_steps') or []
+        yield steps, {key: stack_steps(steps, key) for key in keys}
@@ -0,0 +1,62 @@
+#
+# Copyright The NOMAD Authors.
+#
+# This file is part of NOMAD.
+# See https://nomad-lab.eu for further info.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+'''
+Assigns values in MP units to metainfo quantities without creating pint quantities.
+The factors to the SI units of the quantities are computed once with pint. Values are
+multiplied by the same factors pint would use, so the results are identical to
+assigning pint quantities.
+'''
+from functools import lru_cache
+import numpy as np
+
+
+@lru_cache(maxsize=None)
+def get_factor(unit, target):
+    '''
+    Returns the factor that converts values in unit, e.g. 'THz * h', to target.
+    '''
+    from nomad.units import ureg
+
+    return ureg.Quantity(1.0, unit).to(target).magnitude
+
+
+def to_si(value, unit, target):
+    '''
+    Converts a number or a nested list of numbers in unit to target, lists and arrays
+    are converted to float64 arrays.
+    '''
+    return scale(value, get_factor(unit, target))
+
+
+def scale(value, factor):
+    '''
+    Multiplies a number or a nested list of numbers with factor, see to_si.
+    '''
+    if isinstance(value, (list, tuple, np.ndarray)):
+        return np.asarray(value, dtype=np.float64) * factor
+    return value * factor
+
+
+def set_si(section, name, value, unit):
+    '''
+    Sets the quantity name of section to value, which is given in unit, converted to
+    the unit of the quantity.
+    '''
+    quantity_def = section.m_def.all_quantities[name]
+    section.m_set(quantity_def, to_si(value, unit, quantity_def.unit))
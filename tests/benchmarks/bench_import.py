@@ -0,0 +1,61 @@
+#
+# Copyright The NOMAD Authors.
+#
+# This file is part of NOMAD.
+# See https://nomad-lab.eu for further info.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+'''
+Measures the import time of the mpparser modules in fresh interpreters and checks it
+against a budget, e.g.
+
+    python tests/benchmarks/bench_import.py
+
+Exits with status 1 if a module exceeds its budget. The parser module is measured on
+top of nomad.parsing.parser, which it cannot avoid importing.
+'''
+import sys
+import subprocess
+
+
+# module, modules imported beforehand, budget in ms
+budgets = [
+    ('mpparser', [], 20),
+    ('mpparser.matching', [], 20),
+    ('mpparser.batch', [], 100),
+    ('mpparser.mp_parser', ['nomad.parsing.parser'], 150)]
+
+
+def get_import_time(module, preloaded, repeat=5):
+    code = (
+        'import time; %s'
+        'start = time.perf_counter(); import %s; print(time.perf_counter() - start)') % (
+        ''.join('import %s; ' % name for name in preloaded), module)
+    times = [
+        float(subprocess.check_output([sys.executable, '-c', code]).split()[-1])
+        for _ in range(repeat)]
+    return min(times)
+
+
+def main():
+    exceeded = False
+    for module, preloaded, budget in budgets:
+        time = get_import_time(module, preloaded) * 1e3
+        exceeded |= time > budget
+        print('%-24s %8.1fms %8dms %s' % (module, time, budget, 'exceeded' if time > budget else ''))
+    sys.exit(1 if exceeded else 0)
+
+
+if __name__ == '__main__':
+    main()
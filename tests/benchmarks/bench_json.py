@@ -0,0 +1,62 @@
+#
+# Copyright The NOMAD Authors.
+#
+# This file is part of NOMAD.
+# See https://nomad-lab.eu for further info.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+'''
+Compares the installed json backends on the mp-149 test files, e.g.
+
+    python tests/benchmarks/bench_json.py tests/data/mp-149
+'''
+import os
+import sys
+import time
+
+from mpparser.loader import backends, get_backend, load_json
+from mpparser.mp_parser import get_material_keys
+from mpparser.handlers import registry
+
+
+def timeit(func, repeat=10):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - start) / repeat
+
+
+def main(directory):
+    names = [name for name, backend in backends.items() if backend is not None]
+    print('%-32s %-6s %s' % ('file', 'mode', ''.join('%12s' % name for name in names)))
+    filenames = sorted(os.listdir(directory))
+    totals = {name: [0., 0.] for name in names}
+    for filename in filenames:
+        filepath = os.path.join(directory, filename)
+        keys = get_material_keys() if 'materials' in filename else registry.get_keys()
+        for n, (mode, mode_keys) in enumerate([('full', None), ('keys', keys)]):
+            times = []
+            for name in names:
+                backend = get_backend(name)
+                times.append(timeit(lambda: load_json(filepath, mode_keys, backend=backend)))
+                totals[name][n] += times[-1]
+            print('%-32s %-6s %s' % (filename, mode, ''.join('%10.2fms' % (t * 1e3) for t in times)))
+
+    for n, mode in enumerate(['full', 'keys']):
+        print('%-32s %-6s %s' % (
+            'total', mode, ''.join('%10.2fms' % (totals[name][n] * 1e3) for name in names)))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1] if len(sys.argv) > 1 else 'tests/data/mp-149')
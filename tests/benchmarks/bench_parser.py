@@ -0,0 +1,174 @@
+#
+# Copyright The NOMAD Authors.
+#
+# This file is part of NOMAD.
+# See https://nomad-lab.eu for further info.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+'''
+Times the parser stages on synthetic documents and records their peak memory, e.g.
+
+    python tests/benchmarks/bench_parser.py --size large
+    python tests/benchmarks/bench_parser.py --size small --nsites 8 --n-qpoints 500
+
+The results are compared against the baselines of the size in baselines.json and the
+script exits with 1 if a stage is slower or needs more memory than the baseline times
+the tolerance. Baselines depend on the machine, use --save to record them.
+'''
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import tempfile
+import tracemalloc
+
+from nomad.datamodel import EntryArchive
+from mpparser.mp_parser import MPParser, ParseContext
+from mpparser.loader import load_json
+from mpparser.handlers import registry
+
+from synthetic import sizes, write_documents
+
+
+baselines_path = os.path.join(os.path.dirname(__file__), 'baselines.json')
+handlers = dict(
+    elasticity='parse_elastic', eos='parse_eos', phonon='parse_phonon', thermo='parse_thermo',
+    tasks='parse_tasks')
+# differences below these are noise
+min_time, min_memory = 1e-3, 1 << 16
+
+
+def measure(func, setup, repeat):
+    '''
+    Returns the best time of repeat runs and the peak memory of an additional run.
+    '''
+    times = []
+    for _ in range(repeat):
+        args = setup()
+        start = time.perf_counter()
+        func(*args)
+        times.append(time.perf_counter() - start)
+
+    args = setup()
+    tracemalloc.start()
+    try:
+        func(*args)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return dict(time=min(times), memory=peak)
+
+
+def run(mainfile, repeat):
+    logger = logging.getLogger('mpparser')
+    directory = os.path.dirname(mainfile)
+    material_id = os.path.basename(mainfile).split('_')[0]
+
+    def setup_parser():
+        return MPParser(), ParseContext(EntryArchive(), logger, mainfile)
+
+    def setup_system():
+        parser, context = setup_parser()
+        parser.init_parser(context)
+        return parser, context
+
+    def setup_handler(data):
+        def setup():
+            parser, context = setup_system()
+            parser.parse_system(context)
+            return parser, context, data
+        return setup
+
+    results = dict()
+    results['init_parser'] = measure(MPParser.init_parser, setup_parser, repeat)
+    results['parse_system'] = measure(MPParser.parse_system, setup_system, repeat)
+    for name, handler in handlers.items():
+        path = os.path.join(directory, '%s_%s.json' % (material_id, name))
+        results['load_%s' % name] = measure(
+            lambda: load_json(path, registry.get_keys()), lambda: (), repeat)
+        results[handler] = measure(
+            getattr(MPParser, handler), setup_handler(load_json(path, registry.get_keys())), repeat)
+    results['parse'] = measure(
+        lambda: MPParser().parse(mainfile, EntryArchive(), logger), lambda: (), repeat)
+    return results
+
+
+def compare(results, baselines, tolerance):
+    '''
+    Returns the stages that are slower or need more memory than their baseline.
+    '''
+    regressions = []
+    for stage, result in results.items():
+        baseline = baselines.get(stage)
+        if baseline is None:
+            continue
+        if result['time'] > baseline['time'] * tolerance + min_time:
+            regressions.append('%s is slower' % stage)
+        if result['memory'] > baseline['memory'] * tolerance + min_memory:
+            regressions.append('%s needs more memory' % stage)
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--size', choices=list(sizes), default='small')
+    for key in sizes['small']:
+        parser.add_argument('--%s' % key.replace('_', '-'), type=int, help='overrides the size')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--tolerance', type=float, default=1.5)
+    parser.add_argument('--baselines', default=baselines_path)
+    parser.add_argument('--save', action='store_true', help='stores the results as baselines')
+    args = parser.parse_args(argv)
+
+    size = dict(sizes[args.size])
+    overrides = {key: getattr(args, key) for key in size if getattr(args, key) is not None}
+    size.update(overrides)
+    # custom sizes have no baselines
+    name = 'custom' if overrides else args.size
+
+    with tempfile.TemporaryDirectory(prefix='mpparser_bench_') as directory:
+        mainfile = write_documents(directory, **size)
+        results = run(mainfile, args.repeat)
+
+    baselines = dict()
+    if os.path.exists(args.baselines):
+        with open(args.baselines) as f:
+            baselines = json.load(f)
+
+    print('%-20s %12s %12s %12s %12s' % ('stage', 'time', 'baseline', 'peak memory', 'baseline'))
+    for stage, result in results.items():
+        baseline = baselines.get(name, {}).get(stage, {})
+        print('%-20s %10.2fms %10sms %10.2fMB %10sMB' % (
+            stage, result['time'] * 1e3,
+            '%.2f' % (baseline['time'] * 1e3) if baseline else '-',
+            result['memory'] / 2 ** 20,
+            '%.2f' % (baseline['memory'] / 2 ** 20) if baseline else '-'))
+
+    if args.save:
+        baselines[name] = results
+        with open(args.baselines, 'w') as f:
+            json.dump(baselines, f, indent=2)
+        return
+
+    regressions = compare(results, baselines.get(name, {}), args.tolerance)
+    for regression in regressions:
+        print('regression: %s' % regression)
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+#
+# Copyright The NOMAD Authors.
+#
+# This file is part of NOMAD.
+# See https://nomad-lab.eu for further info.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+'''
+Compares the band structure segmentation of dense q-paths against the former
+element-wise implementation, e.g.
+
+    python tests/benchmarks/bench_segments.py 20000 50000
+'''
+import sys
+import time
+import numpy as np
+
+from mpparser.phonon import get_segments
+
+
+hisym_qpts = [
+    [0.0, 0.0, 0.0], [0.5, 0.0, 0.5], [0.5, 0.25, 0.75], [0.375, 0.375, 0.75],
+    [0.5, 0.5, 0.5], [0.625, 0.25, 0.625]]
+
+
+def make_path(n_qpoints, noise=0.):
+    path = [0, 1, 2, 3, 0, 4, 2, 5, 1]
+    n_points = n_qpoints // (len(path) - 1)
+    qpoints = np.vstack([
+        np.linspace(hisym_qpts[start], hisym_qpts[end], n_points)
+        for start, end in zip(path[:-1], path[1:])])
+    qpoints += np.random.default_rng(0).uniform(-noise, noise, qpoints.shape)
+    return qpoints.tolist()
+
+
+def get_segments_loop(qpoints, hisym_qpts):
+    segments = []
+    endpoints = []
+    for i, qpoint in enumerate(qpoints):
+        if qpoint in hisym_qpts:
+            endpoints.append(i)
+        if len(endpoints) < 2:
+            continue
+        segments.append((
+            endpoints[0], endpoints[1], [hisym_qpts.index(qpoints[i]) for i in endpoints]))
+        endpoints = []
+    return segments
+
+
+def main(sizes):
+    for n_qpoints in sizes:
+        qpoints = make_path(n_qpoints)
+        t0 = time.perf_counter()
+        segments = get_segments_loop(qpoints, hisym_qpts)
+        t1 = time.perf_counter()
+        starts, ends, labels = get_segments(qpoints, hisym_qpts)
+        t2 = time.perf_counter()
+        qpoints_array = np.array(qpoints)
+        t3 = time.perf_counter()
+        get_segments(qpoints_array, hisym_qpts)
+        t4 = time.perf_counter()
+        assert [(s, e, list(l)) for s, e, l in segments] == list(zip(starts, ends, labels.tolist()))
+        print('%8d q-points: loop %.4fs vectorized %.4fs (list conversion %.4fs, from array %.4fs)' % (
+            len(qpoints), t1 - t0, t2 - t1, t3 - t2, t4 - t3))
+
+        # rounding errors in the coordinates break exact matching
+        qpoints = make_path(n_qpoints, noise=1e-9)
+        n_loop = len(get_segments_loop(qpoints, hisym_qpts))
+        n_vectorized = len(get_segments(qpoints, hisym_qpts)[0])
+        print('%8d q-points with rounding noise: loop %d segments vectorized %d segments' % (
+            len(qpoints), n_loop, n_vectorized))
+
+
+if __name__ == '__main__':
+    main([int(size) for size in sys.argv[1:]] or [1000, 10000, 50000])
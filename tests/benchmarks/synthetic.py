@@ -0,0 +1,170 @@
+#
+# Copyright The NOMAD Authors.
+#
+# This file is part of NOMAD.
+# See https://nomad-lab.eu for further info.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+'''
+Generates synthetic MaterialsProject documents of configurable size. The documents
+have the layout of the mp-149 test files but random values.
+'''
+import os
+import json
+import numpy as np
+
+
+hisym_qpts = {
+    '\\Gamma': [0.0, 0.0, 0.0], 'X': [0.5, 0.0, 0.5], 'W': [0.5, 0.25, 0.75],
+    'K': [0.375, 0.375, 0.75], 'L': [0.5, 0.5, 0.5], 'U': [0.625, 0.25, 0.625]}
+qpath = ['\\Gamma', 'X', 'W', 'K', '\\Gamma', 'L', 'W', 'U', 'X']
+elements = ['Si', 'O', 'Fe', 'Li', 'Na', 'Cl', 'Mg', 'Al']
+
+# the sizes of the documents
+sizes = dict(
+    small=dict(
+        nsites=2, n_qpoints=149, n_dos=620, n_fits=8, n_volumes=21, n_decompositions=2,
+        n_calcs=1, n_steps=1),
+    large=dict(
+        nsites=16, n_qpoints=1000, n_dos=5000, n_fits=8, n_volumes=200, n_decompositions=50,
+        n_calcs=10, n_steps=20))
+
+
+def make_structure(rng, nsites):
+    matrix = np.diag(rng.uniform(3, 10, 3)) + rng.uniform(-0.5, 0.5, (3, 3))
+    abc = rng.uniform(0, 1, (nsites, 3))
+    xyz = abc @ matrix
+    labels = [elements[n % len(elements)] for n in range(nsites)]
+    return {
+        '@module': 'pymatgen.core.structure', '@class': 'Structure', 'charge': None,
+        'lattice': {'matrix': matrix.tolist(), 'volume': float(abs(np.linalg.det(matrix)))},
+        'sites': [dict(
+            species=[dict(element=label, occu=1)], abc=abc[n].tolist(), xyz=xyz[n].tolist(),
+            label=label, properties={}) for n, label in enumerate(labels)]}
+
+
+def make_materials(rng, material_id, nsites, **kwargs):
+    structure = make_structure(rng, nsites)
+    labels = [site['label'] for site in structure['sites']]
+    composition = {label: float(labels.count(label)) for label in sorted(set(labels))}
+    return dict(
+        pymatgen_version='2022.0.8', nsites=nsites, nelements=len(composition),
+        elements=[dict(element=element) for element in composition],
+        composition=composition, composition_reduced=composition,
+        formula_pretty=''.join(composition), chemsys='-'.join(composition),
+        volume=structure['lattice']['volume'], density=rng.uniform(1, 10),
+        symmetry=dict(
+            crystal_system='triclinic', symbol='P1', number=1, point_group='1', symprec=0.1),
+        material_id=material_id, structure=structure, task_ids=[material_id],
+        deprecated=False)
+
+
+def make_phonon(rng, material_id, nsites, n_qpoints, n_dos, **kwargs):
+    n_segment = max(n_qpoints // (len(qpath) - 1), 2)
+    qpoints = np.vstack([
+        np.linspace(hisym_qpts[start], hisym_qpts[end], n_segment)
+        for start, end in zip(qpath[:-1], qpath[1:])])
+    n_bands = 3 * nsites
+    shape = (n_bands, len(qpoints), nsites, 3)
+    return dict(
+        material_id=material_id,
+        ph_bs={
+            'qpoints': qpoints.tolist(), 'labels_dict': hisym_qpts,
+            'bands': rng.uniform(0, 20, (n_bands, len(qpoints))).tolist(),
+            'eigendisplacements': dict(
+                real=rng.normal(0, 0.1, shape).tolist(), imag=rng.normal(0, 0.1, shape).tolist()),
+            'structure': make_structure(rng, nsites), 'has_nac': False},
+        ph_dos={
+            'frequencies': np.linspace(0, 20, n_dos).tolist(),
+            'densities': rng.uniform(0, 1, n_dos).tolist(),
+            'pdos': rng.uniform(0, 1, (nsites, n_dos)).tolist(),
+            'structure': make_structure(rng, nsites)})
+
+
+def make_eos(rng, material_id, n_fits, n_volumes, **kwargs):
+    volumes = np.linspace(30, 50, n_volumes)
+    energies = 0.01 * (volumes - 40) ** 2 - 10
+    functions = [
+        'mie_gruneisen', 'pack_evans_james', 'vinet', 'tait', 'birch_euler',
+        'pourier_tarantola', 'birch_lagrange', 'murnaghan']
+    eos = {
+        '%s_%d' % (functions[n % len(functions)], n // len(functions)) if n >= len(functions)
+        else functions[n]: dict(
+            V0=40., B=rng.uniform(0.5, 1), C=4., E0=-10.,
+            eos_energies=(energies + rng.normal(0, 1e-3, n_volumes)).tolist())
+        for n in range(n_fits)}
+    return dict(
+        energies=energies.tolist(), volumes=volumes.tolist(), eos=eos, task_id=material_id)
+
+
+def make_elasticity(rng, material_id, **kwargs):
+    tensor = rng.uniform(0, 200, (6, 6))
+    tensor = (tensor + tensor.T) / 2
+    moduli = {key: rng.uniform(50, 150) for key in [
+        'k_voigt', 'k_reuss', 'k_vrh', 'g_voigt', 'g_reuss', 'g_vrh']}
+    return dict(task_id=material_id, elasticity=dict(
+        moduli, homogeneous_poisson=0.2, elastic_tensor=tensor.tolist(),
+        compliance_tensor=np.linalg.inv(tensor).tolist()))
+
+
+def make_thermo(rng, material_id, nsites, n_decompositions, **kwargs):
+    amounts = rng.uniform(0, 1, n_decompositions)
+    return dict(
+        property_name='thermo', material_id=material_id, nsites=nsites,
+        formation_energy_per_atom=rng.uniform(-3, 0), energy_above_hull=rng.uniform(0, 0.1),
+        is_stable=False, decomposes_to=[dict(
+            material_id='mp-%d' % n, formula=elements[n % len(elements)],
+            amount=amount / amounts.sum()) for n, amount in enumerate(amounts)])
+
+
+def make_tasks(rng, material_id, nsites, n_calcs, n_steps, **kwargs):
+    def make_step():
+        return dict(
+            e_fr_energy=rng.uniform(-20, -10), e_wo_entrp=rng.uniform(-20, -10),
+            e_0_energy=rng.uniform(-20, -10), forces=rng.normal(0, 0.1, (nsites, 3)).tolist(),
+            stress=rng.normal(0, 1, (3, 3)).tolist(), structure=make_structure(rng, nsites))
+
+    calcs = [dict(
+        input=dict(potcar_type=['PAW_PBE'], incar=dict(ENCUT=520., PREC='accurate')),
+        output=dict(
+            energy=rng.uniform(-20, -10), structure=make_structure(rng, nsites),
+            ionic_steps=[make_step() for _ in range(n_steps)])) for _ in range(n_calcs)]
+    return dict(task_id=material_id, nsites=nsites, calcs_reversed=calcs)
+
+
+generators = dict(
+    materials=make_materials, phonon=make_phonon, eos=make_eos, elasticity=make_elasticity,
+    thermo=make_thermo, tasks=make_tasks)
+
+
+def make_documents(material_id='mp-1', seed=0, **size):
+    '''
+    Returns the synthetic documents by name. The size parameters default to the small
+    size, see sizes.
+    '''
+    size = dict(sizes['small'], **size)
+    rng = np.random.default_rng(seed)
+    return {
+        name: generator(rng, material_id, **size) for name, generator in generators.items()}
+
+
+def write_documents(directory, material_id='mp-1', seed=0, **size):
+    '''
+    Writes the synthetic documents to directory and returns the path to the mainfile.
+    '''
+    os.makedirs(directory, exist_ok=True)
+    for name, document in make_documents(material_id, seed, **size).items():
+        with open(os.path.join(directory, '%s_%s.json' % (material_id, name)), 'w') as f:
+            json.dump(document, f)
+    return os.path.join(directory, '%s_materials.json' % material_id)
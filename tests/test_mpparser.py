@@ -17,10 +17,40 @@
 # limitations under the License.
 #
 
+import os
+import bz2
+import io
+import gzip
+import json
+import logging
+import lzma
+import pstats
+import shutil
+import subprocess
+import sys
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+from concurrent.futures import ThreadPoolExecutor
 import pytest
+import numpy as np
 
 from nomad.datamodel import EntryArchive
 from mpparser.mp_parser import MPParser
+from mpparser.directory import get_directory_index
+from mpparser.loader import load_json, prefetch, get_shape, decode_into, backends, JSONBackend
+from mpparser.phonon import get_segments, sum_by_label, EigendisplacementsDecoder
+from mpparser.structure import convert_structure, get_structure_key
+from mpparser.tasks import stack_steps
+from mpparser.units import to_si
+from mpparser.cache import ArchiveCache, main as cache_main
+from mpparser.batch import find_mainfiles, run_batch
+from mpparser.stream import parse_jsonl
+from mpparser.api import MPClient, parse_api
+from mpparser.matching import is_mainfile
+from mpparser.output import write_json, write_msgpack, read_msgpack, MsgpackReader, MsgpackWriter
+from mpparser.handlers import Handler, HandlerRegistry, registry
+from mpparser.incremental import remove_sections
 
 
 def approx(value, abs=0, rel=1e-6):
@@ -32,6 +62,10 @@ def parser():
     return MPParser()
 
 
+def get_phonon_calculation(archive):
+    return next(calc for calc in archive.run[0].calculation if calc.dos_phonon)
+
+
 def test_all(parser):
     archive = EntryArchive()
     parser.parse('tests/data/mp-149/mp-149_materials.json', archive, None)
@@ -43,17 +77,43 @@ def test_all(parser):
     assert sec_system.atoms.labels == ['Si', 'Si']
     assert sec_system.atoms.lattice_vectors[1][2].magnitude == approx(2.734364e-10)
     assert sec_system.atoms.positions[0][0].magnitude == approx(1.367182e-10)
+    assert sec_system.atoms.x_mp_fractional_positions[0] == approx([0.25, 0.25, 0.25])
+    assert sec_system.atoms.x_mp_species.tolist() == [[14], [14]]
     assert sec_system.x_mp_composition_reduced[0].x_mp_value == approx(1.0)
     assert sec_system.x_mp_symmetry[0].x_mp_symprec == approx(0.1)
     assert sec_system.x_mp_elements[0] == 'Si'
     assert sec_system.x_mp_volume == approx(40.88829284866483)
     assert sec_system.x_mp_formula_anonymous == 'A'
+    assert run.x_mp_material_id == 'mp-149'
+    assert run.x_mp_n_tasks == len(run.x_mp_task_ids) == 24
+    assert run.x_mp_deprecated == 'false'
+    assert run.x_mp_calc_types[0].x_mp_label == 'mp-655585'
+    assert run.x_mp_calc_types[0].x_mp_value == 'GGA Static'
+    assert run.x_mp_origins[0].x_mp_task_id == 'mp-1791788'
 
     sec_method = run.method[0]
     assert sec_method.dft.xc_functional.exchange[0].name == 'GGA_X_PBE'
     assert sec_method.basis_set[0].type == 'plane waves'
     assert sec_method.basis_set[0].cell_dependent[0].planewave_cutoff.magnitude == approx(1.0830714e-16)
 
+    # the ionic steps of the tasks in chronological order
+    steps = run.calculation[1:-1]
+    assert len(steps) == 4
+    assert steps[0].energy.total.value.magnitude == approx(-10.84561065 * 1.602176634e-19)
+    assert steps[0].energy.free.value.magnitude == approx(-10.84561065 * 1.602176634e-19)
+    assert steps[0].stress.total.value[0][0].magnitude == approx(19.24640736e8)
+    assert steps[0].system_ref.atoms.lattice_vectors[0][0].magnitude == approx(3.32548851e-10)
+    assert steps[-1].energy.total.value.magnitude == approx(-10.85073298 * 1.602176634e-19)
+    assert steps[-1].forces.total.value.magnitude.tolist() == [[0, 0, 0], [0, 0, 0]]
+    assert steps[-1].method_ref == sec_method
+    # identical structures share one system
+    assert steps[-1].system_ref is steps[-2].system_ref
+    assert len(run.system) == 5
+    # the calculation of the material is the last one, after those of the workflows
+    assert run.calculation[-1].system_ref is sec_system
+    assert run.calculation[-1].method_ref is sec_method
+    assert not run.calculation[-1].dos_phonon and run.calculation[-1].energy is None
+
     assert len(archive.workflow) == 4
     for workflow in archive.workflow:
         if workflow.type == 'elastic':
@@ -80,17 +140,694 @@ def test_all(parser):
                 elif fit.function_name == 'pack_evans_james':
                     assert fit.bulk_modulus.magnitude == approx(8.67365485e+10)
         elif workflow.type == 'phonon':
-            segment = run.calculation[-1].band_structure_phonon[0].segment
+            calc = get_phonon_calculation(archive)
+            segment = calc.band_structure_phonon[0].segment
             assert len(segment) == 10
             assert segment[2].energies[0][7][3].magnitude == approx(7.33184304e-21)
             assert segment[5].kpoints[9][1] == approx(0.32692307692)
             assert segment[9].endpoints_labels == ['U', 'X']
-            dos = run.calculation[-1].dos_phonon[0]
+            # the segments are views into one array of the whole path
+            energies = [section.__dict__['energies'] for section in segment]
+            assert all(value.base is energies[0].base for value in energies)
+            assert energies[0].base.shape == (1, sum(len(value[0]) for value in energies), 6)
+            dos = calc.dos_phonon[0]
+            # the phonons are calculated for a different lattice constant, the material
+            # calculation keeps the system of the material
+            assert calc.system_ref.atoms.lattice_vectors[0][1].magnitude == approx(2.71566670e-10)
+            assert run.calculation[-1].system_ref is run.system[0]
             assert dos.energies[20].magnitude == approx(3.49331979e-22)
             assert dos.total[0].value[35].magnitude == approx(1.27718386e+19)
+            assert [values.atom_index for values in dos.atom_projected] == [0, 1]
+            assert dos.atom_projected[1].atom_label == 'Si'
+            assert len(dos.species_projected) == 1 and dos.species_projected[0].atom_label == 'Si'
+            projected = sum(values.value.magnitude for values in dos.atom_projected)
+            assert dos.species_projected[0].value.magnitude == approx(projected)
+            assert projected == approx(dos.total[0].value.magnitude)
+            eigendisplacements = calc.band_structure_phonon[0].x_mp_eigendisplacements
+            assert eigendisplacements.shape == (6, 149, 2, 3, 2)
+            assert eigendisplacements[5][100][1][2] == approx([-0.0007993209784282559, -0.00033108958995431523])
             phonon = workflow.phonon
             assert phonon.with_non_analytic_correction
         elif workflow.type == 'thermodynamics':
             thermo = workflow.thermodynamics
             assert thermo.stability.formation_energy.magnitude == approx(0)
             assert thermo.stability.is_stable
+
+
+def test_directory_index(tmp_path):
+    for filename, data in [
+            ('mp-1_materials.json', {'material_id': 'mp-1'}),
+            ('mp-1_eos.json', {'task_id': 'mp-1'}),
+            ('mp-10_eos.json', {'task_id': 'mp-10'}),
+            ('phonon.json', {'material_id': 'mp-1'}),
+            # the ids of nested documents are not the id of the file
+            ('thermo.json', {
+                'task_id': 'mp-1', 'decomposes_to': [{'material_id': 'mp-2'}],
+                'material_id': 'mp-1'}),
+            # the id follows a value larger than the sniff size
+            ('tasks.json', {'calcs_reversed': [0] * 5000, 'task_id': 'mp-1'}),
+            ('notes.txt', {})]:
+        with open(tmp_path / filename, 'w') as f:
+            json.dump(data, f)
+
+    index = get_directory_index(str(tmp_path))
+    files = [os.path.basename(f) for f in index.get('mp-1', exclude='mp-1_materials.json')]
+    assert files == ['mp-1_eos.json', 'phonon.json', 'tasks.json', 'thermo.json']
+    assert index.get('mp-2') == []
+    assert get_directory_index(str(tmp_path)) is index
+
+    with open(tmp_path / 'mp-1_thermo.json', 'w') as f:
+        json.dump({'material_id': 'mp-1'}, f)
+    os.utime(tmp_path, ns=(0, os.stat(tmp_path).st_mtime_ns + 1))
+    assert len(get_directory_index(str(tmp_path)).get('mp-1')) == 6
+
+
+def test_load_json_keys():
+    filepath = 'tests/data/mp-149/mp-149_phonon.json'
+    data = load_json(filepath, ['material_id', 'ph_bs.labels_dict', 'ph_dos.*'])
+    assert list(data.keys()) == ['material_id', 'ph_bs', 'ph_dos']
+    assert list(data['ph_bs'].keys()) == ['labels_dict']
+    assert data['ph_bs']['labels_dict']['X'] == approx([0.5, 0.0, 0.5])
+
+    full = load_json(filepath)
+    assert data['ph_dos'] == full['ph_dos']
+
+    data = load_json('tests/data/mp-149/mp-149_tasks.json', ['calcs_reversed.0.input.incar'])
+    assert len(data['calcs_reversed']) == 1
+    assert list(data['calcs_reversed'][0]['input'].keys()) == ['incar']
+
+
+@pytest.mark.parametrize('name', [name for name, backend in backends.items() if backend is not None])
+def test_backends(name):
+    backend = backends[name]()
+    keys = MPParser().handlers.get_keys()
+    for filename in sorted(os.listdir('tests/data/mp-149')):
+        filepath = os.path.join('tests/data/mp-149', filename)
+        with open(filepath) as f:
+            text = f.read()
+        assert backend.loads(text) == json.loads(text)
+        for stream_size in [0, 1 << 24]:
+            np.testing.assert_equal(
+                load_json(filepath, keys, backend=backend, stream_size=stream_size),
+                load_json(filepath, keys, backend=JSONBackend(), stream_size=stream_size))
+
+    # not valid json, but written by the json module
+    text = json.dumps(dict(values=[[1., float('nan')], [float('inf'), -float('inf')]]))
+    np.testing.assert_equal(backend.loads(text), json.loads(text))
+    np.testing.assert_equal(
+        backend.decode_array(text[len('{"values": '):-1]), np.array(json.loads(text)['values']))
+
+
+def test_decode_array():
+    backend = JSONBackend()
+    array = backend.decode_array(' [[[1, 2.5], [3, -4e-3]], [[5, 6], [7, 8]]] ', dtype=np.float32)
+    assert array.dtype == np.float32 and array.shape == (2, 2, 2)
+    assert array[0, 1] == approx([3, -4e-3])
+    assert backend.decode_array('[[], []]').shape == (2, 0)
+    assert backend.decode_array([[1, 2]]).shape == (1, 2)
+    assert backend.decode_array('null') is None
+    with pytest.raises(ValueError):
+        backend.decode_array('[[1, 2], [3]]')
+    with pytest.raises(ValueError):
+        backend.decode_array('[[1, 2], [3, "a"]]')
+    # ragged lists with the number of values of a regular array
+    for text in [
+            '[[1,2],[3],[4,5,6]]', '[[[1, 2], [3, 4]], [[5, 6]], [[7, 8], [9, 10], [11, 12]]]',
+            '[[1], 2]', '[[1, 2], [3, 4]] ]']:
+        for chunk_size in [1, 3, 1 << 20]:
+            with pytest.raises(ValueError):
+                get_shape(text, chunk_size=chunk_size)
+        with pytest.raises(ValueError):
+            backend.decode_array(text)
+    assert get_shape('[[[1, 2], [3, 4]], [[5, 6], [7, 8]], [[9, 10], [11, 12]]]', 5) == (3, 2, 2)
+
+
+def test_handlers(tmp_path):
+    directory = 'tests/data/mp-149'
+    sniffed = {
+        filename.split('_', 1)[1]: [handler.name for handler in registry.sniff(os.path.join(directory, filename))]
+        for filename in os.listdir(directory) if filename != 'mp-149_materials.json'}
+    assert sniffed == {
+        'elasticity.json': ['elastic'], 'eos.json': ['eos'], 'phonon.json': ['phonon'],
+        'thermo.json': ['thermo'], 'tasks.json': ['tasks'], 'dielectric.json': [],
+        'magnetism.json': [], 'piezoelectric.json': [], 'surface_properties.json': []}
+
+    # without the file name suffix, the handlers are detected from the top-level keys
+    shutil.copy(os.path.join(directory, 'mp-149_eos.json'), tmp_path / 'mp-149_other.json')
+    assert [handler.name for handler in registry.sniff(str(tmp_path / 'mp-149_other.json'))] == ['eos']
+    # keys beyond the head are not read
+    assert 'eos' not in HandlerRegistry(sniff_size=1024).sniff_keys(str(tmp_path / 'mp-149_other.json'))
+
+    magnetism = []
+    handlers = HandlerRegistry(registry)
+    handlers.register(Handler(
+        'magnetism', lambda parser, context, data: magnetism.append(data), ['magnetism'],
+        keys=['magnetism.ordering'], suffixes=['_magnetism']))
+    with pytest.raises(ValueError):
+        handlers.register(Handler('eos', 'parse_eos', ['eos']))
+    archive = EntryArchive()
+    MPParser(handlers=handlers).parse(os.path.join(directory, 'mp-149_materials.json'), archive, None)
+    assert magnetism == [dict(task_id='mp-149', magnetism=dict(ordering='NM'))]
+    assert len(archive.workflow) == 4
+
+
+def test_sum_by_label():
+    values = np.arange(10.).reshape(5, 2)
+    labels, sums = sum_by_label(values, ['O', 'Ti', 'O', 'Sr', 'O'])
+    assert labels == ['O', 'Ti', 'Sr']
+    assert sums.tolist() == [[12., 15.], [2., 3.], [6., 7.]]
+
+
+def test_get_segments():
+    hisym_qpts = [[0.0, 0.0, 0.0], [0.5, 0.0, 0.5], [0.5, 0.5, 0.5]]
+    qpoints = [
+        [0.0, 0.0, 0.0], [0.25, 0.0, 0.25], [0.5, 0.0, 0.5 + 1e-9],
+        [0.5, 0.0, 0.5], [0.5, 0.25, 0.5], [0.5, 0.5, 0.5]]
+    starts, ends, labels = get_segments(qpoints, hisym_qpts)
+    assert list(starts) == [0, 3]
+    assert list(ends) == [2, 5]
+    assert labels.tolist() == [[0, 1], [1, 2]]
+
+    starts, ends, labels = get_segments(qpoints, hisym_qpts, tolerance=0)
+    assert list(starts) == [0]
+    assert list(ends) == [3]
+
+
+def test_convert_structure():
+    structure = dict(lattice=dict(matrix=[[4., 0, 0], [0, 4., 0], [0, 0, 2.]]), sites=[
+        dict(species=[dict(element='Fe', occu=0.5), dict(element='Ni', occu=0.5)],
+             abc=[0.5, 0.5, 0.5], label='Fe:0.500, Ni:0.500'),
+        dict(species=[dict(element='O', occu=1)], abc=[0., 0.25, 0.5], xyz=[0., 1., 1.])])
+    converted = convert_structure(structure)
+    assert converted['labels'] == ['Fe:0.500, Ni:0.500', 'O']
+    # the first site has no cartesian coordinates, they are derived from the lattice
+    assert converted['positions'].tolist() == [[2., 2., 1.], [0., 1., 1.]]
+    assert converted['fractional_positions'][1].tolist() == [0., 0.25, 0.5]
+    assert converted['species'].tolist() == [[26, 28], [8, 0]]
+    assert converted['occupancies'].tolist() == [[0.5, 0.5], [1., 0.]]
+
+    del structure['sites'][0]['abc']
+    structure['sites'][0]['xyz'] = [2., 2., 1.]
+    converted = convert_structure(structure)
+    assert converted['positions'].tolist() == [[2., 2., 1.], [0., 1., 1.]]
+    assert converted['fractional_positions'].ravel() == approx([0.5, 0.5, 0.5, 0., 0.25, 0.5])
+
+    empty = convert_structure(dict(sites=[]))
+    assert empty['positions'] is None and empty['species'].shape == (0, 0)
+
+    # equal within the tolerance and wrapped into the unit cell
+    key = get_structure_key(converted)
+    structure['sites'][0]['abc'] = [0.5, 0.5, 0.5]
+    structure['sites'][1]['abc'] = [1. - 1e-9, 0.25 + 1e-9, 0.5]
+    assert get_structure_key(convert_structure(structure)) == key
+    structure['sites'][1]['abc'] = [0., 0.26, 0.5]
+    assert get_structure_key(convert_structure(structure)) != key
+    assert get_structure_key(empty) == get_structure_key(convert_structure(dict(sites=[])))
+
+
+def test_stack_steps():
+    steps = [dict(energy=1., forces=[[0, 1, 2]]), dict(forces=[[3, 4, 5]]), dict(energy=3.)]
+    energies = stack_steps(steps, 'energy')
+    assert energies[[0, 2]].tolist() == [1., 3.] and np.isnan(energies[1])
+    assert stack_steps(steps, 'forces').shape == (3, 1, 3)
+    assert np.isnan(stack_steps(steps, 'forces')[2]).all()
+    assert stack_steps(steps, 'stress') is None
+    # values of different shape are not stacked
+    assert stack_steps(steps + [dict(forces=[[0, 1, 2], [3, 4, 5]])], 'forces') is None
+
+
+def test_to_si():
+    from nomad.units import ureg
+
+    values = [[1, 2.5], [1e-3, 7.1]]
+    for unit in ['GPa', '1 / GPa', 'eV / angstrom ** 3', 'THz * h', '1 / (THz * h)']:
+        target = (1 * ureg(unit)).to_base_units().units
+        # identical to converting pint quantities
+        assert np.array_equal(
+            to_si(values, unit, target), (values * ureg(unit)).to(target).magnitude)
+        assert to_si(7.1, unit, target) == (7.1 * ureg(unit)).to(target).magnitude
+
+
+def test_eigendisplacements_mmap():
+    archive = EntryArchive()
+    MPParser(eigendisplacements_dtype=np.complex64, mmap_threshold=0).parse(
+        'tests/data/mp-149/mp-149_materials.json', archive, None)
+    eigendisplacements = get_phonon_calculation(archive).band_structure_phonon[0].x_mp_eigendisplacements
+    assert eigendisplacements.dtype == np.float32
+    assert isinstance(eigendisplacements.base, np.memmap)
+    assert eigendisplacements[0][1][0][0] == approx([0.0016507243728041917, -6.188805669391732e-05])
+
+
+def test_decode_into():
+    real = np.arange(24, dtype=np.float64).reshape(2, 3, 4) / 7
+    text = json.dumps(real.tolist())
+    for chunk_size in [1, 10, 1 << 20]:
+        shape = get_shape(text, chunk_size=chunk_size)
+        assert shape == (2, 3, 4)
+        out = np.zeros(shape, dtype=np.complex64)
+        decode_into(text, out.imag, chunk_size=chunk_size)
+        assert np.all(out.real == 0)
+        assert out.imag == approx(real)
+
+    with pytest.raises(ValueError):
+        get_shape('[[[1, 2]], [[3, 4], [5, 6]]]')
+    with pytest.raises(ValueError):
+        decode_into('[[1, 2], [3]]', np.zeros((2, 2)))
+
+    decoder = EigendisplacementsDecoder(np.complex64)
+    eigendisplacements = decoder.real(text)
+    assert decoder.imag((-real).tolist()) is eigendisplacements
+    assert eigendisplacements == approx(real - 1j * real)
+    with pytest.raises(ValueError):
+        decoder.imag('[[1, 2], [3, 4]]')
+
+
+def test_decode_errors(tmp_path):
+    for name in ['materials', 'phonon']:
+        shutil.copy('tests/data/mp-149/mp-149_%s.json' % name, str(tmp_path))
+    phonon = tmp_path / 'mp-149_phonon.json'
+    data = json.loads(phonon.read_text())
+    # irregular arrays only drop the quantities they belong to
+    data['ph_dos']['pdos'][0].pop()
+    data['ph_bs']['eigendisplacements']['imag'][0].pop()
+    phonon.write_text(json.dumps(data))
+
+    errors = []
+    loaded = load_json(str(phonon), ['ph_dos.pdos', 'ph_dos.densities'], errors=errors)
+    assert errors == []
+    keys = MPParser().handlers.get_keys()
+    # streamed and decoded at once
+    for stream_size in [0, 1 << 24]:
+        errors = []
+        decoded = load_json(str(phonon), keys, stream_size=stream_size, errors=errors)
+        assert sorted(errors) == ['imag', 'pdos']
+        assert 'pdos' not in decoded['ph_dos']
+        assert decoded['ph_dos']['densities'] == loaded['ph_dos']['densities']
+        with pytest.raises(ValueError):
+            load_json(str(phonon), keys, stream_size=stream_size)
+
+    logger = RecordingLogger()
+    archive = EntryArchive()
+    MPParser().parse(str(tmp_path / 'mp-149_materials.json'), archive, logger)
+    assert archive.workflow[0].type == 'phonon'
+    calc = get_phonon_calculation(archive)
+    assert len(calc.dos_phonon[0].total) == 1
+    assert len(calc.dos_phonon[0].atom_projected) == 0
+    assert len(calc.band_structure_phonon[0].segment) > 0
+    assert calc.band_structure_phonon[0].x_mp_eigendisplacements is None
+    warnings = [fields for event, fields in logger.events if event.startswith('Failed to decode')]
+    assert warnings == [dict(file=str(phonon), keys=['imag', 'pdos'])]
+
+
+def test_batch(tmp_path):
+    broken = tmp_path / 'input' / 'mp-0_materials.json'
+    broken.parent.mkdir()
+    broken.write_text('{"pymatgen_version": ')
+
+    mainfiles = find_mainfiles(['tests/data', str(tmp_path / 'input' / '*.json')])
+    assert sorted(os.path.basename(mainfile) for mainfile in mainfiles) == [
+        'mp-0_materials.json', 'mp-149_materials.json']
+
+    summary = run_batch(mainfiles, str(tmp_path / 'output'), processes=2, max_in_flight=1)
+    assert summary['n_mainfiles'] == 2
+    assert summary['n_failures'] == 1
+    results = {os.path.basename(result['mainfile']): result for result in summary['results']}
+    assert 'error' in results['mp-0_materials.json']
+    with open(results['mp-149_materials.json']['archive']) as f:
+        assert json.load(f)['run'][0]['program']['name'] == 'MaterialsProject'
+    assert os.path.isfile(tmp_path / 'output' / 'summary.json')
+
+
+def test_output(parser):
+    archive = EntryArchive()
+    parser.parse('tests/data/mp-149/mp-149_materials.json', archive, None)
+    expected = archive.m_to_dict()
+
+    f = io.StringIO()
+    write_json(archive, f)
+    assert json.loads(f.getvalue()) == expected
+
+    f = io.BytesIO()
+    write_msgpack(archive, f)
+    assert len(f.getvalue()) < len(json.dumps(expected)) / 2
+    f.seek(0)
+    read = read_msgpack(f)
+    assert read.m_to_dict() == expected
+    eigendisplacements = get_phonon_calculation(read).band_structure_phonon[0].x_mp_eigendisplacements
+    assert eigendisplacements.shape == (6, 149, 2, 3, 2)
+
+    values = [
+        None, True, -1, -200, 1 << 40, 0.5, 'a' * 300, b'ab', dict(a=[1, 2]), list(range(20)),
+        {str(n): n for n in range(20)}]
+    f = io.BytesIO()
+    writer = MsgpackWriter(f)
+    writer.pack(values + [np.arange(6, dtype='>i4').reshape(2, 3)])
+    writer.flush()
+    decoded = MsgpackReader(f.getvalue()).read()
+    assert decoded[:-1] == values
+    assert decoded[-1].dtype == np.dtype('<i4') and decoded[-1].tolist() == [[0, 1, 2], [3, 4, 5]]
+
+
+def test_parse_jsonl(tmp_path):
+    def load(name):
+        return load_json('tests/data/mp-149/mp-149_%s.json' % name)
+
+    def write(name, documents):
+        with open(tmp_path / name, 'w') as f:
+            for document in documents:
+                f.write('%s\n' % json.dumps(document))
+        return str(tmp_path / name)
+
+    material = load('materials')
+    eos = load('eos')
+    materials = write('materials.jsonl', [
+        dict(material, material_id='mp-2'), material, dict(material, material_id='mp-150')])
+    properties = [
+        write('eos.jsonl', [dict(eos, task_id='mp-1'), dict(eos, task_id='mp-2'), eos]),
+        write('phonon.jsonl', [load('phonon')]),
+        write('thermo.jsonl', [load('thermo'), dict(load('thermo'), material_id='mp-150')])]
+
+    archives = list(parse_jsonl(materials, properties))
+    assert len(archives) == 3
+    assert [len(archive.workflow) for archive in archives] == [1, 3, 1]
+    assert archives[1].workflow[1].type == 'phonon'
+    assert archives[2].workflow[0].type == 'thermodynamics'
+
+    unsorted = write('unsorted.jsonl', [material, dict(material, material_id='mp-2')])
+    with pytest.raises(ValueError):
+        list(parse_jsonl(unsorted, []))
+
+
+def test_parse_api():
+    def load(name, material_id='mp-149'):
+        data = load_json('tests/data/mp-149/mp-149_%s.json' % name)
+        return json.loads(json.dumps(data).replace('mp-149', material_id))
+
+    documents = {
+        '/materials/summary/': [load('materials'), load('materials', 'mp-150')],
+        '/materials/eos/': [load('eos')],
+        '/materials/phonon/': [load('phonon')],
+        '/materials/thermo/': [load('thermo'), load('thermo', 'mp-150')]}
+    requests = []
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            url = urlsplit(self.path)
+            query = {key: value[0] for key, value in parse_qs(url.query).items()}
+            requests.append((url.path, query, self.headers.get('X-API-KEY')))
+            if url.path == '/materials/thermo/' and len([r for r in requests if r[0] == url.path]) == 1:
+                # the first thermo request is rate limited by the server
+                self.send_response(429)
+                self.send_header('Retry-After', '0')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            material_ids = query['material_ids'].split(',')
+            data = [
+                document for document in documents[url.path]
+                if document.get('material_id', document.get('task_id')) in material_ids]
+            skip, limit = int(query['_skip']), int(query['_limit'])
+            body = json.dumps(dict(data=data[skip:skip + limit], meta=dict(total_doc=len(data))))
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body.encode())))
+            self.end_headers()
+            self.wfile.write(body.encode())
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        endpoints = {name: path for name, path in zip(
+            ['materials', 'eos', 'phonon', 'thermo'], documents)}
+        with MPClient(
+                'http://127.0.0.1:%d' % server.server_port, api_key='key', endpoints=endpoints,
+                batch_size=2, pool_size=2, rate=None, backoff=0.01) as client:
+            archives = list(parse_api(['mp-149', 'mp-404', 'mp-150'], client))
+            n_connections = client.pool.n_connections
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    assert len(archives) == 2
+    assert [len(archive.workflow) for archive in archives] == [3, 1]
+    assert archives[0].workflow[1].type == 'phonon'
+    assert archives[1].workflow[0].type == 'thermodynamics'
+    assert archives[1].run[0].system[0].atoms.labels == archives[0].run[0].system[0].atoms.labels
+    # one request per batch and endpoint and a retry of the rate limited request
+    assert len(requests) == 2 * 4 + 1
+    assert {query['material_ids'] for _, query, _ in requests} == {'mp-149,mp-404', 'mp-150'}
+    assert all(key == 'key' for _, _, key in requests)
+    assert n_connections <= 2
+
+
+def test_compressed(tmp_path):
+    compressions = dict(
+        materials=(gzip, 'gz'), phonon=(bz2, 'bz2'), eos=(lzma, 'xz'), elasticity=(gzip, 'gz'))
+    for filename in os.listdir('tests/data/mp-149'):
+        source = os.path.join('tests/data/mp-149', filename)
+        name = filename[len('mp-149_'):-len('.json')]
+        if name not in compressions:
+            shutil.copy(source, tmp_path / filename)
+            continue
+        compression, extension = compressions[name]
+        target = tmp_path / ('%s.%s' % (filename, extension))
+        with open(source, 'rb') as f_in, compression.open(target, 'wb') as f_out:
+            shutil.copyfileobj(f_in, f_out)
+
+    mainfile = str(tmp_path / 'mp-149_materials.json.gz')
+    assert find_mainfiles([str(tmp_path)]) == [mainfile]
+    archive = EntryArchive()
+    MPParser().parse(mainfile, archive, None)
+    assert archive.run[0].system[0].atoms.labels == ['Si', 'Si']
+    assert sorted(workflow.type for workflow in archive.workflow) == [
+        'elastic', 'equation_of_state', 'phonon', 'thermodynamics']
+
+
+def test_matching():
+    assert is_mainfile('mp-149_materials.json.gz', '{"pymatgen_version": "2022.0.8"}')
+    assert not is_mainfile('mp-149_materials.json', '{"material_id": "mp-149"}')
+    assert not is_mainfile('mp-149_phonon.json')
+
+    # matching and finding mainfiles does not import nomad or numpy
+    code = (
+        'import sys, mpparser.matching, mpparser.batch; '
+        'print(sorted({name.split(".")[0] for name in sys.modules} & {"nomad", "numpy", "pint"}))')
+    env = dict(os.environ, PYTHONPATH=os.getcwd())
+    assert subprocess.check_output([sys.executable, '-c', code], env=env).strip() == b'[]'
+
+
+class RecordingLogger:
+    def __init__(self):
+        self.events = []
+
+    def debug(self, event, **kwargs):
+        self.events.append((event, kwargs))
+
+    def info(self, event, **kwargs):
+        self.events.append((event, kwargs))
+
+    def warning(self, event, **kwargs):
+        self.events.append((event, kwargs))
+
+    def error(self, event, **kwargs):
+        self.events.append((event, kwargs))
+
+
+def test_instrumentation(tmp_path, caplog):
+    logger = RecordingLogger()
+    parser = MPParser(trace_memory=True, profile_dir=str(tmp_path))
+    mainfile = 'tests/data/mp-149/mp-149_materials.json'
+    parser.parse(mainfile, EntryArchive(), logger)
+
+    stages = [fields for event, fields in logger.events if event == 'parser stage']
+    assert [stage['stage'] for stage in stages[:3]] == [
+        'init_parser', 'directory_index', 'parse_system']
+    assert stages[0]['bytes_read'] == os.path.getsize(mainfile)
+    assert all(stage['wall_time'] >= 0 and stage['memory_peak'] >= 0 for stage in stages)
+    sniffs = [stage for stage in stages if stage['stage'] == 'sniff_workflow']
+    assert len(sniffs) == stages[1]['n_files'] == 9
+    # dielectric, magnetism, piezoelectric and surface properties have no handler
+    assert len([stage for stage in stages if stage['stage'] == 'load_workflow']) == 5
+    assert len([stage for stage in stages if stage['stage'] == 'parse_workflow']) == 5
+
+    event, summary = logger.events[-1]
+    assert event == 'parser stages'
+    assert summary['bytes_read'] == sum(stage.get('bytes_read', 0) for stage in stages)
+
+    stats = pstats.Stats(str(tmp_path / 'mp-149_materials.prof'))
+    assert any(function[2] == 'parse_phonon' for function in stats.stats)
+
+    # the stages are logged at debug level, only the summary at info level
+    with caplog.at_level(logging.INFO, logger='mpparser.test'):
+        parser.parse(mainfile, EntryArchive(), logging.getLogger('mpparser.test'))
+    assert [record.getMessage() for record in caplog.records] == ['parser stages']
+
+
+def test_prefetch():
+    submitted = []
+
+    def load(item):
+        submitted.append(item)
+        return item * 2
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        loaded = prefetch(executor, load, range(5), 2)
+        assert next(loaded) == 0
+        # one more item is submitted with each result taken
+        assert sorted(submitted) == [0, 1, 2]
+        assert list(loaded) == [2, 4, 6, 8]
+
+    def parse(parser):
+        logger = RecordingLogger()
+        archive = EntryArchive()
+        parser.parse('tests/data/mp-149/mp-149_materials.json', archive, logger)
+        files = [
+            fields['file'] for event, fields in logger.events
+            if event == 'parser stage' and fields['stage'] == 'parse_workflow']
+        return archive, files
+
+    archive, files = parse(MPParser())
+    prefetched, prefetched_files = parse(MPParser(prefetch=4))
+    assert prefetched_files == files
+    assert prefetched.m_to_dict() == archive.m_to_dict()
+
+
+def test_concurrent_parse(tmp_path):
+    # a second material, so that concurrent calls parse different documents
+    shutil.copytree('tests/data/mp-149', tmp_path / 'data')
+    for path in (tmp_path / 'data').iterdir():
+        path.write_text(path.read_text().replace('mp-149', 'mp-150').replace('"Si"', '"Ge"'))
+        path.rename(tmp_path / 'data' / path.name.replace('mp-149', 'mp-150'))
+    mainfiles = ['tests/data/mp-149/mp-149_materials.json', str(tmp_path / 'data' / 'mp-150_materials.json')]
+
+    def parse(parser, mainfile):
+        archive = EntryArchive()
+        parser.parse(mainfile, archive, None)
+        return archive.m_to_dict()
+
+    expected = [parse(MPParser(), mainfile) for mainfile in mainfiles]
+    parser = MPParser(prefetch=2)
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        results = list(executor.map(lambda mainfile: parse(parser, mainfile), mainfiles * 4))
+    assert results == expected * 4
+    assert expected[0] != expected[1]
+    # the parser does not keep the state of the last call
+    assert not {'data', 'archive', 'filepath', 'logger'} & set(vars(parser))
+
+
+def test_archive_cache(tmp_path, capsys):
+    shutil.copytree('tests/data/mp-149', tmp_path / 'data')
+    mainfile = str(tmp_path / 'data' / 'mp-149_materials.json')
+    cache_dir = str(tmp_path / 'cache')
+
+    def parse():
+        logger = RecordingLogger()
+        archive = EntryArchive()
+        MPParser(cache_dir=cache_dir).parse(mainfile, archive, logger)
+        hits = [
+            fields['hit'] for event, fields in logger.events
+            if event == 'parser stage' and fields['stage'] == 'archive_cache']
+        return archive, hits[0]
+
+    archive, hit = parse()
+    assert not hit
+    cached, hit = parse()
+    assert hit
+    assert cached.m_to_dict() == archive.m_to_dict()
+
+    # a changed workflow file invalidates the entry
+    with open(tmp_path / 'data' / 'mp-149_thermo.json') as f:
+        thermo = json.load(f)
+    thermo['energy_above_hull'] = 0.1
+    with open(tmp_path / 'data' / 'mp-149_thermo.json', 'w') as f:
+        json.dump(thermo, f)
+    archive, hit = parse()
+    assert not hit
+    assert archive.workflow[-1].thermodynamics.stability.delta_formation_energy.magnitude > 0
+
+    cache = ArchiveCache(cache_dir)
+    entries = cache.entries()
+    assert len(entries) == 2
+    assert cache.prune(entries[-1]['size']) == entries[-1]['size']
+    assert [entry['key'] for entry in cache.entries()] == [entries[-1]['key']]
+
+    cache_main(['--dir', cache_dir, 'info'])
+    assert '1 entries' in capsys.readouterr().out
+    # without a size, the cache is only pruned to the default cache size
+    cache_main(['--dir', cache_dir, 'prune'])
+    assert len(cache.entries()) == 1
+    cache_main(['--dir', cache_dir, 'prune', '--max-size', '0'])
+    assert cache.entries() == []
+
+
+def test_parse_incremental(tmp_path):
+    shutil.copytree('tests/data/mp-149', tmp_path / 'data')
+    mainfile = str(tmp_path / 'data' / 'mp-149_materials.json')
+    parser = MPParser()
+
+    archive = EntryArchive()
+    sources = parser.parse_incremental(mainfile, archive)
+    expected = EntryArchive()
+    parser.parse(mainfile, expected, None)
+    assert archive.m_to_dict() == expected.m_to_dict()
+    assert sorted(sources['mp-149_phonon.json']['sections']) == [
+        '/run/0/calculation/0', '/run/0/system/1', '/workflow/2']
+
+    # references to removed sections are unset, the others follow the new indices
+    run = expected.run[0]
+    remove_sections(list(run.method) + [run.system[1]])
+    assert all(calc.method_ref is None for calc in run.calculation)
+    assert run.calculation[0].system_ref is None
+    assert run.calculation[1].system_ref is run.system[1]
+    assert run.calculation[-1].system_ref is run.system[0]
+    assert expected.m_to_dict()['run'][0]['calculation'][1]['system_ref'] == '/run/0/system/1'
+
+    # nothing changed, nothing is parsed
+    logger = RecordingLogger()
+    assert parser.parse_incremental(mainfile, archive, sources, logger) == sources
+    assert logger.events[-1][1]['n_parsed'] == 0
+
+    # only the changed thermo file is parsed again, the other sections are kept
+    phonon = archive.workflow[2]
+    with open(tmp_path / 'data' / 'mp-149_thermo.json') as f:
+        thermo = json.load(f)
+    thermo['energy_above_hull'] = 0.1
+    with open(tmp_path / 'data' / 'mp-149_thermo.json', 'w') as f:
+        json.dump(thermo, f)
+    logger = RecordingLogger()
+    updated = parser.parse_incremental(mainfile, archive, sources, logger)
+    assert logger.events[-1][1]['n_parsed'] == 1
+    assert archive.workflow[2] is phonon
+    assert [workflow.type for workflow in archive.workflow] == [
+        'elastic', 'equation_of_state', 'phonon', 'thermodynamics']
+    assert archive.workflow[3].thermodynamics.stability.delta_formation_energy.magnitude > 0
+    assert updated['mp-149_thermo.json']['hash'] != sources['mp-149_thermo.json']['hash']
+
+    # removed files remove their sections
+    os.remove(tmp_path / 'data' / 'mp-149_elasticity.json')
+    updated = parser.parse_incremental(mainfile, archive, updated)
+    assert 'mp-149_elasticity.json' not in updated
+    assert [workflow.type for workflow in archive.workflow] == [
+        'equation_of_state', 'phonon', 'thermodynamics']
+    assert '/workflow/1' in updated['mp-149_phonon.json']['sections']
+
+    # the references of the remaining sections to those of removed files are unset
+    os.remove(tmp_path / 'data' / 'mp-149_phonon.json')
+    os.remove(tmp_path / 'data' / 'mp-149_tasks.json')
+    updated = parser.parse_incremental(mainfile, archive, updated)
+    assert [workflow.type for workflow in archive.workflow] == [
+        'equation_of_state', 'thermodynamics']
+    run = archive.run[0]
+    assert not run.method and len(run.system) == 1
+    assert len(run.calculation) == 1
+    assert run.calculation[0].system_ref is run.system[0]
+    assert run.calculation[0].method_ref is None
+    expected = EntryArchive()
+    parser.parse(mainfile, expected, None)
+    assert archive.m_to_dict() == expected.m_to_dict()